@@ -1,13 +1,367 @@
-from openai import OpenAI
-import tiktoken
+from openai.types.chat import ChatCompletion
+import asyncio
+import openai
 import os
+import threading
+import time
+import LLM_Backend
+import LLM_Cache
+import Rate_Limiter
+import Context_Builder
+import Email_Extractor
+import Token_Counter
+import Summary_Tree
+import Telemetry
+import Text_Chunker
 import Gmail_Interface
 import dotenv
 
 # load the environment variables
 dotenv.load_dotenv()
 
-client = OpenAI()  # Automatically uses OPENAI_API_KEY from environment
+# Retries are handled by send_request, under the shared rate limits, not by the client.
+# The client comes from LLM_Backend: the OpenAI API unless LLM_BACKEND=local.
+client = LLM_Backend.get_backend().client()  # Automatically uses OPENAI_API_KEY from environment
+
+# Bump when a prompt template changes so cached outputs for the old wording are retired
+PROMPT_VERSION = 1
+
+# Serve repeated requests from the on-disk completion cache instead of the API
+USE_COMPLETION_CACHE = True
+_completion_cache = None
+
+# Account limits per model (requests and tokens per minute), longest prefix match wins
+REQUESTS_PER_MINUTE = {
+    "gpt-4": 500,
+    "gpt-4o": 500,
+    "gpt-4.1": 500,
+    "gpt-3.5-turbo": 500,
+}
+TOKENS_PER_MINUTE = {
+    "gpt-4": 10000,
+    "gpt-4o": 30000,
+    "gpt-4o-mini": 200000,
+    "gpt-4.1": 30000,
+    "gpt-4.1-mini": 200000,
+    "gpt-4.1-nano": 200000,
+    "gpt-3.5-turbo": 200000,
+}
+
+# Completion tokens assumed for a request that does not set max_tokens, until usage is known
+ESTIMATED_COMPLETION_TOKENS = 500
+
+# Requests someone is waiting on go ahead of background summarizing
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Transient failures are retried with jittered exponential backoff
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+MAX_RETRIES = 6
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def use_backend(backend):
+    """
+    Send every completion from now on, and the embeddings of vector collections created
+    after this, through another LLM_Backend backend.
+    """
+    global client
+    LLM_Backend.set_backend(backend)
+    client = backend.client()
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
+
+def get_completion_cache():
+    """
+    Returns:
+        LLM_Cache.CompletionCache: The shared completion cache, opened on first use, or None
+            if caching is turned off
+    """
+    global _completion_cache
+    if USE_COMPLETION_CACHE and _completion_cache is None:
+        _completion_cache = LLM_Cache.CompletionCache()
+    return _completion_cache if USE_COMPLETION_CACHE else None
+
+def rate_limiter(model):
+    """
+    Returns:
+        Rate_Limiter.PriorityRateLimiter: The limiter shared by every request to a model
+    """
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            # A backend standing in for the API has its own limits; otherwise use the account's
+            limits = LLM_Backend.get_backend().rate_limits(model) or (
+                Token_Counter.model_limit(REQUESTS_PER_MINUTE, model),
+                Token_Counter.model_limit(TOKENS_PER_MINUTE, model),
+            )
+            _rate_limiters[model] = Rate_Limiter.PriorityRateLimiter(*limits)
+        return _rate_limiters[model]
+
+def estimate_tokens(request):
+    """
+    Returns:
+        int: Tokens a request is expected to use, prompt and completion together
+    """
+    prompt_tokens = sum(Token_Counter.count_many(
+        [message["content"] for message in request["messages"]], request["model"]))
+    return prompt_tokens + request.get("max_tokens", ESTIMATED_COMPLETION_TOKENS)
+
+def is_retryable_openai_error(error):
+    """
+    Check whether an OpenAI error is transient (rate limiting, a server error or a dropped
+    connection).
+    """
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUSES
+
+def retry_delay(error, attempt):
+    """
+    Returns:
+        float: Seconds to wait before retrying, as the server asked if it said
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), Rate_Limiter.MAX_DELAY)
+    except (TypeError, ValueError):
+        return Rate_Limiter.backoff_delay(attempt)
+
+def record_failure(stage, request, error, final, latency, wait):
+    Telemetry.record("chat", stage, request["model"], "error" if final else "retry", latency,
+                     wait=wait, error=type(error).__name__)
+
+def record_completion(stage, request, usage, latency, wait=0.0, first_token_latency=None):
+    Telemetry.record("chat", stage, request["model"], "ok", latency,
+                     usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+                     first_token_latency=first_token_latency, wait=wait)
+
+def send_request(request, priority=BACKGROUND, stream=False, stage=None):
+    """
+    Send a chat completion request under the model's rate limits, retrying transient errors.
+    Every attempt is recorded in Telemetry.
+
+    Args:
+        request (dict): Arguments for client.chat.completions.create
+        priority (int): INTERACTIVE or BACKGROUND
+        stream (bool): Stream the completion; usage is then settled and recorded by the caller
+        stage (str): Pipeline stage making the request, for Telemetry
+
+    Returns:
+        ChatCompletion, or if stream is set a tuple of (stream of chunks, time.perf_counter()
+            when the request was admitted past the rate limits, seconds spent waiting for them)
+    """
+    limiter = rate_limiter(request["model"])
+    estimate = estimate_tokens(request)
+    for attempt in range(MAX_RETRIES + 1):
+        queued = time.perf_counter()
+        limiter.acquire(estimate, priority)
+        start = time.perf_counter()
+        try:
+            if stream:
+                return client.chat.completions.create(
+                    **request, stream=True, stream_options={"include_usage": True}), start, start - queued
+            completion = client.chat.completions.create(**request)
+        except Exception as e:
+            final = attempt == MAX_RETRIES or not is_retryable_openai_error(e)
+            record_failure(stage, request, e, final, time.perf_counter() - start, start - queued)
+            if final:
+                raise
+            time.sleep(retry_delay(e, attempt))
+            continue
+        limiter.settle(estimate, completion.usage.total_tokens if completion.usage else estimate)
+        record_completion(stage, request, completion.usage, time.perf_counter() - start, start - queued)
+        return completion
+
+async def send_request_async(async_client, request, priority=BACKGROUND, stage=None):
+    """
+    Async version of send_request on an async client (AsyncOpenAI or LLM_Backend's). Waiting for the rate limits
+    happens on a worker thread so the event loop keeps running.
+    """
+    limiter = rate_limiter(request["model"])
+    estimate = estimate_tokens(request)
+    for attempt in range(MAX_RETRIES + 1):
+        queued = time.perf_counter()
+        await asyncio.to_thread(limiter.acquire, estimate, priority)
+        start = time.perf_counter()
+        try:
+            completion = await async_client.chat.completions.create(**request)
+        except Exception as e:
+            final = attempt == MAX_RETRIES or not is_retryable_openai_error(e)
+            record_failure(stage, request, e, final, time.perf_counter() - start, start - queued)
+            if final:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+            continue
+        limiter.settle(estimate, completion.usage.total_tokens if completion.usage else estimate)
+        record_completion(stage, request, completion.usage, time.perf_counter() - start, start - queued)
+        return completion
+
+def create_completion(priority=BACKGROUND, stage=None, **request):
+    """
+    Create a chat completion, reusing the cached result of an identical earlier request.
+
+    Args:
+        priority (int): INTERACTIVE or BACKGROUND
+        stage (str): Pipeline stage making the request, for Telemetry
+        **request: Arguments for client.chat.completions.create
+
+    Returns:
+        ChatCompletion: The completion
+    """
+    cache = get_completion_cache()
+    if cache is None:
+        return send_request(request, priority, stage=stage)
+
+    key = LLM_Cache.cache_key(request, PROMPT_VERSION)
+    completion = cache.get(key)
+    if completion is None:
+        completion = send_request(request, priority, stage=stage)
+        cache.put(key, completion)
+    else:
+        Telemetry.record("chat", stage, request["model"], "cached")
+    return completion
+
+async def create_completion_async(async_client, priority=BACKGROUND, stage=None, **request):
+    """
+    Async version of create_completion on an async client.
+    """
+    cache = get_completion_cache()
+    if cache is None:
+        return await send_request_async(async_client, request, priority, stage)
+
+    key = LLM_Cache.cache_key(request, PROMPT_VERSION)
+    completion = cache.get(key)
+    if completion is None:
+        completion = await send_request_async(async_client, request, priority, stage)
+        cache.put(key, completion)
+    else:
+        Telemetry.record("chat", stage, request["model"], "cached")
+    return completion
+
+class CompletionStream:
+    """
+    Iterable over the text of a chat completion as the API streams it.
+
+    After iterating, `text` holds the whole output, and `first_token_latency` and
+    `total_latency` the seconds from sending the request to its first and last piece,
+    not counting any wait for the rate limits.
+    Like create_completion it goes through the completion cache and the rate limits: an
+    identical earlier request is replayed in one piece, and a stream that finishes is stored.
+
+    Args:
+        request (dict): Arguments for client.chat.completions.create, or None to replay `text`
+        text (str): Output to replay when there is no request
+        error_text (str): Output if the request fails before anything arrives
+        on_complete (callable): Called with the full text once the stream has finished cleanly
+        priority (int): INTERACTIVE or BACKGROUND
+        stage (str): Pipeline stage making the request, for Telemetry
+    """
+
+    def __init__(self, request=None, text="", error_text="", on_complete=None, priority=INTERACTIVE,
+                 stage=None):
+        self.request = request
+        self.text = text
+        self.error_text = error_text
+        self.on_complete = on_complete
+        self.priority = priority
+        self.stage = stage
+        self.first_token_latency = None
+        self.total_latency = None
+
+    def __iter__(self):
+        start = time.perf_counter()
+        if self.request is None:
+            yield from self._replay(start, self.text)
+            return
+
+        cache = get_completion_cache()
+        key = LLM_Cache.cache_key(self.request, PROMPT_VERSION) if cache is not None else None
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            Telemetry.record("chat", self.stage, self.request["model"], "cached")
+            yield from self._replay(start, cached.choices[0].message.content.strip())
+            return
+
+        pieces = []
+        last_chunk = None
+        finish_reason = None
+        stream = None
+        wait = 0.0
+        try:
+            # Latencies are timed from admission, so they leave out the wait for the rate limits
+            stream, start, wait = send_request(self.request, self.priority, stream=True, stage=self.stage)
+            for chunk in stream:
+                last_chunk = chunk
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                piece = chunk.choices[0].delta.content
+                if piece:
+                    if self.first_token_latency is None:
+                        self.first_token_latency = time.perf_counter() - start
+                    pieces.append(piece)
+                    yield piece
+        except Exception as e:
+            print(f"Error streaming response: {e}")
+            # Failures before the stream opened were recorded by send_request
+            if stream is not None:
+                record_failure(self.stage, self.request, e, True, time.perf_counter() - start, wait)
+            if not pieces:
+                yield from self._replay(start, self.error_text)
+                return
+            finish_reason = None
+
+        self.text = ''.join(pieces).strip()
+        self.total_latency = time.perf_counter() - start
+        # With include_usage set, the last chunk carries the usage for the whole stream
+        usage = getattr(last_chunk, "usage", None)
+        if usage is not None:
+            rate_limiter(self.request["model"]).settle(estimate_tokens(self.request), usage.total_tokens)
+        if finish_reason is None:
+            return
+        record_completion(self.stage, self.request, usage, self.total_latency, wait,
+                          first_token_latency=self.first_token_latency)
+        if cache is not None:
+            cache.put(key, completion_from_stream(last_chunk, self.text, finish_reason))
+        if self.on_complete is not None:
+            self.on_complete(self.text)
+
+    def _replay(self, start, text):
+        self.text = text
+        self.first_token_latency = self.total_latency = time.perf_counter() - start
+        if text:
+            yield text
+
+    def read(self):
+        """
+        Consume the stream without printing it.
+
+        Returns:
+            str: The full output
+        """
+        for _ in self:
+            pass
+        return self.text
+
+
+def completion_from_stream(last_chunk, text, finish_reason):
+    """
+    Returns:
+        ChatCompletion: A completion equivalent to a finished stream, for the cache
+    """
+    return ChatCompletion.model_validate({
+        'id': last_chunk.id,
+        'object': 'chat.completion',
+        'created': last_chunk.created,
+        'model': last_chunk.model,
+        'choices': [{
+            'index': 0,
+            'finish_reason': finish_reason,
+            'message': {'role': 'assistant', 'content': text},
+        }],
+    })
 
 def num_tokens_from_string(string: str, model: str = "gpt-4") -> int:
     """Returns the number of tokens in a text string for a specified model.
@@ -19,213 +373,369 @@ def num_tokens_from_string(string: str, model: str = "gpt-4") -> int:
     Returns:
         int: Number of tokens in the string
     """
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    # Encoders and counts are cached, so repeated counts of the same text are free
+    return Token_Counter.count_tokens(string, model)
+
+# Model for each stage of the pipeline. High-volume stages run on a small fast model, while
+# the final digest and answers keep the quality model. Any stage can be overridden with an
+# environment variable named after it, such as LEAF_SUMMARY_MODEL=gpt-4.1-mini.
+STAGE_MODELS = {
+    "clean": "gpt-4o-mini",
+    "leaf_summary": "gpt-4o-mini",
+    "extract": "gpt-4o-mini",
+    "reduce": "gpt-4",
+    "answer": "gpt-4",
+}
+
+def model_for(stage):
+    """
+    Returns:
+        str: The model that runs a pipeline stage
+    """
+    return os.getenv(f"{stage.upper()}_MODEL", STAGE_MODELS[stage])
+
+def input_budget(stage, prompt, reply_tokens):
+    """
+    Returns:
+        int: Tokens of input that fit in one call for a stage, next to the prompt and a reply
+            of up to reply_tokens (or the model's output limit, if lower)
+    """
+    model = model_for(stage)
+    reply_tokens = min(reply_tokens, Token_Counter.max_output_tokens(model))
+    return Token_Counter.context_window(model) - num_tokens_from_string(prompt, model) - reply_tokens
+
+SUMMARY_PROMPT = """Please provide a concise summary of the following email content. Focus on:
+- Key topics and main points
+- Important requests or actions needed
+- Relevant dates, people, or deadlines mentioned
+- Overall purpose/intent of the communication
+
+Keep the summary brief but informative. The summary should be substantially shorter than the original text. 
+
+If the text provided appears to already be a summary, limit any additional summary to one to two sentences.
+
+Content to summarize:
+"""
+
+# Tokens kept free in the context window for the summary itself
+SUMMARY_RESPONSE_TOKENS = 1000
+
+# Long-context models still summarize very long inputs poorly, so no summary call is given
+# more than this however large the model's window is
+MAX_SUMMARY_INPUT_TOKENS = 32000
+
+EMAIL_SEPARATOR = "\n\n--- Email ---\n"
+
+# Summary requests AsyncSummarizer keeps in flight at once
+SUMMARY_CONCURRENCY = 8
+
+# How summarize_array groups texts into calls: 'ffd' (first-fit-decreasing) makes the
+# fewest calls, 'ordered' keeps neighbouring emails together
+PACKING_STRATEGY = 'ffd'
+
+# Keep email digests in a persistent Summary_Tree so a refresh only re-summarizes what changed
+USE_SUMMARY_TREE = True
+_summary_tree = None
+
+def summary_input_budget(stage="reduce"):
+    """
+    Returns:
+        int: Tokens of content that fit in one summary call of a stage alongside the prompt
+            and reply
+    """
+    return min(MAX_SUMMARY_INPUT_TOKENS, input_budget(stage, SUMMARY_PROMPT, SUMMARY_RESPONSE_TOKENS))
+
+def get_summary_tree():
+    """
+    Returns:
+        Summary_Tree.SummaryTree: The shared summary tree, opened on first use
+    """
+    global _summary_tree
+    if _summary_tree is None:
+        _summary_tree = Summary_Tree.SummaryTree()
+    return _summary_tree
+
+def email_texts(emails):
+    """
+    Prefix each email's text with its sender and subject, ready for summarizing.
+
+    Returns:
+        tuple: (list of texts, list of their token counts)
+    """
+    if USE_SUMMARY_TREE:
+        # Oldest first, so new mail only touches the right-hand edge of the tree
+        emails = sorted(emails, key=lambda email: (email.internal_date, email.message_id or ""))
 
-def summarize_Emails(emails):
     # Process emails by prepending subject and sender information
     processed_emails = []
+    headers = []
+    bodies = []
     for email in emails:
+        # An email that has been through Email_Extractor is summarized from its extraction
+        body = Email_Extractor.extraction_text(email.extraction) if email.extraction else email.text
+        bodies.append(body)
         # Start with the email text
-        email_with_subject = Gmail_Interface.prepend_with_title("Subject", email.subject, email.text)
+        email_with_subject = Gmail_Interface.prepend_with_title("Subject", email.subject, body)
         # Add sender information at the very beginning
         email_with_metadata = Gmail_Interface.prepend_with_title("From", email.sender, email_with_subject)
         processed_emails.append(email_with_metadata)
-    
+        headers.append(Gmail_Interface.prepend_with_title(
+            "From", email.sender, Gmail_Interface.prepend_with_title("Subject", email.subject, "")))
+
+    # Bodies are already counted on the Email objects, so only the short headers (and any
+    # extractions) need encoding
+    token_counts = [
+        header_count + (num_tokens_from_string(body) if email.extraction else email.token_count)
+        for header_count, body, email in zip(Token_Counter.count_many(headers), bodies, emails)
+    ]
+    return processed_emails, token_counts
+
+def summarize_Emails(emails):
+    processed_emails, token_counts = email_texts(emails)
+
     # Now summarize the processed emails
-    return summarize_array(processed_emails)
+    if USE_SUMMARY_TREE:
+        return get_summary_tree().summarize(processed_emails, token_counts)
+    return summarize_array(processed_emails, token_counts=token_counts)
+
+def stream_summarize_Emails(emails):
+    """
+    Streaming version of summarize_Emails: everything below the final reduce step runs
+    first, then the final summary streams as it is generated.
 
-def summarize_array(array, depth=0):
+    Returns:
+        CompletionStream: The digest, piece by piece
+    """
+    processed_emails, token_counts = email_texts(emails)
+    if USE_SUMMARY_TREE:
+        return get_summary_tree().stream(processed_emails, token_counts)
+    return stream_summarize_array(processed_emails, token_counts=token_counts)
+
+def summarize_array(array, depth=0, token_counts=None):
     '''
     Summarize an array of strings into a single string using recursive chunking.
+
+    The chunks at each level of the tree are summarized concurrently; see AsyncSummarizer.
     
     Args:
         array (list): List of strings to summarize
+        depth (int): Recursion depth to prevent infinite loops
+        token_counts (list): Token count of each string, if already known
         
     Returns:
         str: Single summarized string
     '''
-    if not array:
-        return ""
-    
-    # Add depth protection
-    if depth > 5:  # Prevent infinite recursion
-        return "Summary truncated due to recursion limit."
-    
-    # Define token limits (leaving buffer for prompt and response)
-    MAX_TOKENS = 5000  # Conservative limit for gpt-4
-    
-    # First, handle individual strings that are too long
-    processed_strings = []
-    for text in array:
-        if num_tokens_from_string(text) > MAX_TOKENS:
-            # Split oversized text into chunks
-            chunks = split_text_into_chunks(text, MAX_TOKENS)
-            # Recursively summarize the chunks
-            chunk_summary = summarize_array(chunks, depth + 1)
-            processed_strings.append(chunk_summary)
-        else:
-            processed_strings.append(text)
-    
-    # Now combine strings until we hit the token limit
-    combined_chunks = []
-    current_chunk = ""
-    
-    for text in processed_strings:
-        # Check if adding this text would exceed the limit
-        test_chunk = current_chunk + "\n\n--- Email ---\n" + text if current_chunk else text
-        
-        if num_tokens_from_string(test_chunk) > MAX_TOKENS:
-            if current_chunk:
-                combined_chunks.append(current_chunk)
-                current_chunk = text
-            else:
-                # Single text is too long, this shouldn't happen after preprocessing
-                combined_chunks.append(text)
-        else:
-            current_chunk = test_chunk
-    
-    # Add the last chunk if it exists
-    if current_chunk:
-        combined_chunks.append(current_chunk)
-    
-    # If we only have one chunk, summarize it directly
-    if len(combined_chunks) == 1:
-        return summarize_text(combined_chunks[0])
-    
-    # If we have multiple chunks, summarize each and then recursively summarize the summaries
-    summaries = []
-    for chunk in combined_chunks:
-        summary = summarize_text(chunk)
-        summaries.append(summary)
-    
-    # Recursively summarize the summaries
-    return summarize_array(summaries, depth + 1)
+    async def run():
+        async with LLM_Backend.get_backend().async_client() as async_client:
+            return await AsyncSummarizer(async_client).summarize_array(array, depth, token_counts)
+
+    return asyncio.run(run())
 
-# need to test this
-def split_text_into_chunks(text, max_tokens):
+def stream_summarize_array(array, depth=0, token_counts=None):
     """
-    Split a text into chunks that fit within the token limit.
-    
-    Args:
-        text (str): Text to split
-        max_tokens (int): Maximum tokens per chunk
-        
+    Streaming version of summarize_array. The levels below the final reduce step are
+    summarized concurrently as usual, and only the final summary streams.
+
     Returns:
-        list: List of text chunks
+        CompletionStream: The summary, piece by piece
     """
-    # Simple approach: split by sentences first, then by characters if needed
-    sentences = text.split('. ')
-    chunks = []
-    current_chunk = ""
-    
-    for sentence in sentences:
-        test_chunk = current_chunk + ". " + sentence if current_chunk else sentence
+    async def run():
+        async with LLM_Backend.get_backend().async_client() as async_client:
+            return await AsyncSummarizer(async_client).reduce(array, depth, token_counts)
+
+    final_chunk = asyncio.run(run())
+    if final_chunk is None:
+        return CompletionStream(text="Summary truncated due to recursion limit.")
+    return stream_summarize_text(final_chunk)
+
+
+class AsyncSummarizer:
+    """
+    Hierarchical summarizer that runs every summary call on one level of the tree at once,
+    with at most `concurrency` requests in flight.
+
+    The client is an async client from LLM_Backend, bound to the running event loop, so a summarizer lives
+    for a single asyncio.run.
+    """
+
+    def __init__(self, async_client, concurrency=SUMMARY_CONCURRENCY):
+        self.client = async_client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # Calls that failed even after retries and fell back to truncated text
+        self.errors = 0
+
+    async def summarize_text(self, text, stage="reduce"):
+        """
+        Async version of summarize_text.
+        """
+        if not text or text.strip() == "":
+            return ""
+
+        try:
+            async with self.semaphore:
+                completion = await create_completion_async(self.client, stage=stage, **summary_request(text, stage))
+            return summary_from_completion(completion, text)
+
+        except Exception as e:
+            print(f"Error summarizing text: {e}")
+            self.errors += 1
+            return text[:500]  # Return truncated version as fallback
+
+    async def summarize_array(self, array, depth=0, token_counts=None, stage="reduce"):
+        """
+        Async version of summarize_array. The final summary is written by the model for
+        `stage`, so intermediate sub-trees can stay on the leaf model.
+        """
+        final_chunk = await self.reduce(array, depth, token_counts, stage)
+        if final_chunk is None:
+            return "Summary truncated due to recursion limit."
+        return await self.summarize_text(final_chunk, stage)
+
+    async def reduce(self, array, depth=0, token_counts=None, final_stage="reduce"):
+        """
+        Summarize an array level by level until what is left fits in one summary call of
+        final_stage. Emails are summarized on the leaf model, and summaries of summaries on
+        the reduce model.
+
+        Returns:
+            str: The final chunk still to be summarized, or None if the recursion limit was hit
+        """
+        if not array:
+            return ""
         
-        if num_tokens_from_string(test_chunk) > max_tokens:
-            if current_chunk:
-                chunks.append(current_chunk + "\n\n[CHUNK_BREAK]\n")  # Add special separator
-                current_chunk = sentence
-            else:
-                # Single sentence is too long, split by characters
-                char_chunks = split_by_characters(sentence, max_tokens)
-                # Add separator to all but the last chunk
-                for i, chunk in enumerate(char_chunks[:-1]):
-                    chunks.append(chunk + "\n\n[CHUNK_BREAK]\n")
-                chunks.append(char_chunks[-1])  # Last chunk doesn't need separator
-        else:
-            current_chunk = test_chunk
-    
-    if current_chunk:
-        chunks.append(current_chunk)
-    
-    return chunks
+        # Add depth protection
+        if depth > 5:  # Prevent infinite recursion
+            return None
+        
+        if token_counts is None:
+            token_counts = Token_Counter.count_many(array)
+        # Joining two texts can merge a token across the seam, so each separator is charged
+        # one extra token
+        separator_tokens = num_tokens_from_string(EMAIL_SEPARATOR) + 1
+        final_budget = summary_input_budget(final_stage)
+        if sum(token_counts) + separator_tokens * (len(array) - 1) <= final_budget:
+            return EMAIL_SEPARATOR.join(array)
+
+        # Fill each call up to the stage model's context window, leaving room for the prompt and reply
+        stage = "leaf_summary" if depth == 0 else final_stage
+        max_tokens = summary_input_budget(stage)
+        
+        # First, handle individual strings that are too long, summarizing their chunks
+        # alongside everything else on this level
+        oversized = [i for i, token_count in enumerate(token_counts) if token_count > max_tokens]
+        chunk_summaries = await asyncio.gather(*(
+            self.summarize_array(split_text_into_chunks(array[i], max_tokens), depth + 1, stage=stage)
+            for i in oversized
+        ))
+
+        processed_strings = list(array)
+        processed_counts = list(token_counts)
+        for i, chunk_summary in zip(oversized, chunk_summaries):
+            processed_strings[i] = chunk_summary
+            processed_counts[i] = num_tokens_from_string(chunk_summary)
+        if oversized and sum(processed_counts) + separator_tokens * (len(array) - 1) <= final_budget:
+            return EMAIL_SEPARATOR.join(processed_strings)
+        
+        # Pack strings into as few calls as possible using the counts alone
+        bins = Text_Chunker.pack(processed_counts, max_tokens, separator_tokens, PACKING_STRATEGY)
+        combined_chunks = [EMAIL_SEPARATOR.join(processed_strings[i] for i in items) for items in bins]
+        
+        # Summarize them all at once and then recursively reduce the summaries
+        summaries = await asyncio.gather(*(self.summarize_text(chunk, stage) for chunk in combined_chunks))
+        return await self.reduce(list(summaries), depth + 1, final_stage=final_stage)
+
+CHUNK_BREAK = "\n\n[CHUNK_BREAK]\n"
 
-def split_by_characters(text, max_tokens):
+def split_text_into_chunks(text, max_tokens, overlap=0):
     """
-    Split text by characters when sentence-level splitting isn't sufficient.
-    
+    Split a text into chunks that fit within the token limit.
+
+    The text is tokenized once and cut on token offsets, preferring paragraph and then
+    sentence boundaries. Every chunk but the last ends with a [CHUNK_BREAK] separator,
+    and the separator is counted against max_tokens.
+
     Args:
         text (str): Text to split
         max_tokens (int): Maximum tokens per chunk
-        
+        overlap (int): Tokens repeated at the start of each chunk from the end of the last
+
     Returns:
         list: List of text chunks
     """
-    chunks = []
-    # Rough estimate: 1 token ≈ 4 characters
-    approx_chars_per_chunk = max_tokens * 3  # Conservative estimate
-    
-    for i in range(0, len(text), approx_chars_per_chunk):
-        chunk = text[i:i + approx_chars_per_chunk]
-        chunks.append(chunk)
-    
-    return chunks
+    if num_tokens_from_string(text) <= max_tokens:
+        return [text]
+
+    budget = max(1, max_tokens - num_tokens_from_string(CHUNK_BREAK))
+    chunks = Text_Chunker.chunk_text(text, budget, overlap)
+    return [chunk + CHUNK_BREAK for chunk in chunks[:-1]] + chunks[-1:]
 
-def summarize_text(text):
+def summary_request(text, stage="reduce"):
+    """
+    Returns:
+        dict: Chat completion arguments for summarizing text in a pipeline stage
+    """
+    return {
+        "model": model_for(stage),
+        "messages": [
+            {
+                "role": "user",
+                "content": SUMMARY_PROMPT + text
+            }
+        ],
+        "temperature": 0.3,
+    }
+
+def summary_from_completion(completion, text):
+    summary = completion.choices[0].message.content.strip()
+    
+    # Safety check: if summary is longer than original, truncate it
+    if len(summary) > len(text):
+        print(f"Warning: Summary ({len(summary)} chars) longer than original ({len(text)} chars). Truncating.")
+        summary = summary[:len(text)//2]  # Make it at least half the original length
+    
+    return summary
+
+def summarize_text(text, stage="reduce", priority=BACKGROUND):
     """
     Summarize a single text using GPT.
     
     Args:
         text (str): Text to summarize
+        stage (str): Pipeline stage whose model writes the summary
+        priority (int): INTERACTIVE or BACKGROUND
         
     Returns:
         str: Summarized text
     """
     if not text or text.strip() == "":
         return ""
-    
-    prompt = """Please provide a concise summary of the following email content. Focus on:
-- Key topics and main points
-- Important requests or actions needed
-- Relevant dates, people, or deadlines mentioned
-- Overall purpose/intent of the communication
-
-Keep the summary brief but informative. The summary should be substantially shorter than the original text. 
-
-If the text provided appears to already be a summary, limit any additional summary to one to two sentences.
-
-Content to summarize:
-"""
-
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "user", 
-                    "content": prompt + text
-                }
-            ],
-            temperature=0.3
-        )
-        
-        summary = completion.choices[0].message.content.strip()
-        
-        # Safety check: if summary is longer than original, truncate it
-        if len(summary) > len(text):
-            print(f"Warning: Summary ({len(summary)} chars) longer than original ({len(text)} chars). Truncating.")
-            summary = summary[:len(text)//2]  # Make it at least half the original length
-        
-        return summary
+        completion = create_completion(priority, stage, **summary_request(text, stage))
+        return summary_from_completion(completion, text)
     
     except Exception as e:
         print(f"Error summarizing text: {e}")
         return text[:500]  # Return truncated version as fallback
 
-def clean_email_text(text, max_tokens =5000, depth=0):
+def stream_summarize_text(text, on_complete=None, stage="reduce"):
     """
-    Clean email text with proper chunking and recursion protection.
-    
+    Streaming version of summarize_text.
+
     Args:
-        text (str): Text to clean
-        max_tokens (int): Maximum tokens allowed
-        depth (int): Recursion depth to prevent infinite loops
-    """    
+        text (str): Text to summarize
+        on_complete (callable): Called with the full summary once it has streamed
+        stage (str): Pipeline stage whose model writes the summary
+
+    Returns:
+        CompletionStream: The summary, piece by piece
+    """
+    if not text or text.strip() == "":
+        return CompletionStream(text="")
+    return CompletionStream(summary_request(text, stage), error_text=text[:500], on_complete=on_complete,
+                            stage=stage)
 
-    prompt = '''Please extract and return only the main body content from this email text. 
+CLEAN_PROMPT = '''Please extract and return only the main body content from this email text. 
     
     Remove any HTML artifacts or formatting remnants. If the email is a forwarded email, treat the header data of the forwarded email as part of the body, and leave it in.
     For example, if person X forwards an email to person Y from person Z, the email address from person Z should still be included.  
@@ -235,31 +745,65 @@ def clean_email_text(text, max_tokens =5000, depth=0):
     Email text:
     '''
 
-    # Safeguard to prevent infinite recursion and bankrupting me with API calls
-    if depth > 5:
-        return text[:max_tokens*4]
+def clean_input_budget():
+    """
+    Returns:
+        int: Tokens of email text one cleaning call can take. The cleaned text can be as long
+            as the input, so the input gets at most half of what the prompt leaves free, and
+            no more than the model can write back.
+    """
+    model = model_for("clean")
+    free = Token_Counter.context_window(model) - num_tokens_from_string(CLEAN_PROMPT, model)
+    return min(free // 2, Token_Counter.max_output_tokens(model))
+
+def clean_request(text):
+    """
+    Returns:
+        dict: Chat completion arguments for cleaning an email text
+    """
+    return {
+        "model": model_for("clean"),
+        "messages": [
+            {
+                "role": "user", 
+                "content": CLEAN_PROMPT + text
+            }
+        ],
+        "temperature": 0.1,
+    }
+
+def clean_from_completion(completion):
+    cleaned = completion.choices[0].message.content.strip()
+    if cleaned == "You didn't provide any email text. Please provide the text so I can extract the main body content.":
+        return ""
+    return cleaned
+
+def clean_email_text(text, max_tokens=None, depth=0):
+    """
+    Clean email text with proper chunking and recursion protection.
     
+    Args:
+        text (str): Text to clean
+        max_tokens (int): Maximum tokens allowed, prompt included. Defaults to what the
+            cleaning model can take.
+        depth (int): Recursion depth to prevent infinite loops
+    """    
+
     # Calculate available tokens for text
-    prompt_tokens = num_tokens_from_string(prompt)
-    available_tokens = max_tokens - prompt_tokens
+    if max_tokens is None:
+        available_tokens = clean_input_budget()
+    else:
+        available_tokens = max_tokens - num_tokens_from_string(CLEAN_PROMPT)
+
+    # Safeguard to prevent infinite recursion and bankrupting me with API calls
+    if depth > 5:
+        return truncate_text_to_tokens(text, available_tokens)
     
     # If text fits, process it
     if num_tokens_from_string(text) <= available_tokens:
         try:
-            completion = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {
-                        "role": "user", 
-                        "content": prompt + text
-                    }
-                ],
-                temperature=0.1
-            )
-
-            if completion.choices[0].message.content.strip() == "You didn't provide any email text. Please provide the text so I can extract the main body content.":
-                return ""
-            return completion.choices[0].message.content.strip()
+            completion = create_completion(stage="clean", **clean_request(text))
+            return clean_from_completion(completion)
         except Exception as e:
             print(f"Error cleaning email text: {e}")
             return text
@@ -271,7 +815,7 @@ def clean_email_text(text, max_tokens =5000, depth=0):
         
         if len(chunks) == 1:
             # Even after chunking, it's still too long - truncate
-            return text[:available_tokens*4]  # Rough character limit
+            return truncate_text_to_tokens(text, available_tokens)
         
         # Process each chunk recursively
         cleaned_chunks = []
@@ -281,21 +825,89 @@ def clean_email_text(text, max_tokens =5000, depth=0):
         
         return " ".join(cleaned_chunks)
 
-def answer_question_with_context(question, from_address, email_context, max_tokens):
+ANSWER_ERROR = "Sorry, I couldn't process your request due to an error."
+
+# Tokens kept free in the context window for the answer itself
+ANSWER_RESPONSE_TOKENS = 1000
+
+def answer_input_budget():
+    """
+    Returns:
+        int: Tokens the whole question-answering prompt may use on the answer model
+    """
+    model = model_for("answer")
+    return Token_Counter.context_window(model) - min(ANSWER_RESPONSE_TOKENS, Token_Counter.max_output_tokens(model))
+
+def answer_question_with_context(question, from_address, email_context, max_tokens=None):
     return answer_question_with_context_helper(question, Gmail_Interface.prepend_with_title("From", from_address, email_context), max_tokens)
 
-def answer_question_with_context_helper(question, email_context, max_tokens):
+def stream_answer_question_with_context(question, from_address, email_context, max_tokens=None):
+    return stream_answer_question_with_context_helper(question, Gmail_Interface.prepend_with_title("From", from_address, email_context), max_tokens)
+
+def answer_question_with_context_helper(question, email_context, max_tokens=None):
     """
     Answer a user question using email context, with automatic summarization if too long.
     
     Args:
         question (str): The user's question
         email_context (str): The email context to base the answer on
-        max_tokens (int): Maximum tokens allowed for the request
+        max_tokens (int): Maximum tokens allowed for the request. Defaults to what the
+            answer model can take.
         
     Returns:
         str: GPT's response based on the context
     """
+    try:
+        prompt = answer_prompt(question, email_context, max_tokens)
+        completion = create_completion(INTERACTIVE, "answer", **answer_request(prompt))
+        return completion.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Error getting response: {e}")
+        return ANSWER_ERROR
+
+def stream_answer_question_with_context_helper(question, email_context, max_tokens=None):
+    """
+    Streaming version of answer_question_with_context_helper.
+
+    Returns:
+        CompletionStream: The answer, piece by piece
+    """
+    try:
+        prompt = answer_prompt(question, email_context, max_tokens)
+    except Exception as e:
+        print(f"Error getting response: {e}")
+        return CompletionStream(text=ANSWER_ERROR)
+    return CompletionStream(answer_request(prompt), error_text=ANSWER_ERROR, stage="answer")
+
+def answer_request(prompt):
+    """
+    Returns:
+        dict: Chat completion arguments for answering from a prompt built by answer_prompt
+    """
+    return {
+        "model": model_for("answer"),
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        "temperature": 0.1,
+    }
+
+def answer_prompt(question, email_context, max_tokens=None):
+    """
+    Build the question-answering prompt. If the whole email does not fit in max_tokens,
+    only the excerpts most relevant to the question are included, chosen locally by
+    Context_Builder, so every question is answered with exactly one completion call.
+
+    Returns:
+        str: The prompt to answer
+    """
+    if max_tokens is None:
+        max_tokens = answer_input_budget()
+    model = model_for("answer")
+
     # Create the prompt
     prompt = f"""Based on the following email context, please answer this question: {question}
 
@@ -305,134 +917,21 @@ Email Context:
 Answer:"""
     
     # Check if the prompt fits within token limits
-    prompt_tokens = num_tokens_from_string(prompt)
-    
-    if prompt_tokens <= max_tokens:
+    if num_tokens_from_string(prompt, model) <= max_tokens:
         # Prompt fits, send directly
-        try:
-            completion = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.1
-            )
-            return completion.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"Error getting response: {e}")
-            return "Sorry, I couldn't process your request due to an error."
-    
-    else:
-        # Prompt is too long, need to summarize
-        # First, try summarizing just the email context
-        summarized_context = summarize_text(email_context)
-        
-        # Create new prompt with summarized context
-        new_prompt = f"""Based on the following email context summary, please answer this question: {question}
+        return prompt
 
-Email Context Summary:
-{summarized_context}
-
-Answer:"""
-        
-        # Check if this fits now
-        if num_tokens_from_string(new_prompt) <= max_tokens:
-            try:
-                completion = client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": new_prompt
-                        }
-                    ],
-                    temperature=0.1
-                )
-                return completion.choices[0].message.content.strip()
-            except Exception as e:
-                print(f"Error getting response: {e}")
-                return "Sorry, I couldn't process your request due to an error."
-        
-        else:
-            # Even the summarized context is too long, summarize the question too
-
-            summarized_question = question
-
-            if num_tokens_from_string(question) <= max_tokens:
-                try:
-                    completion = client.chat.completions.create(
-                        model="gpt-4",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": "Summarize this question: " + question
-                            }
-                        ],
-                        temperature=0.1
-                    )
-                    summarized_question = completion.choices[0].message.content.strip()
-                except Exception as e:
-                    print(f"Error getting response: {e}")
-                    return "Sorry, I couldn't process your request due to an error."
-            
-            final_prompt = f"""Based on the following email context summary, please answer this question: {summarized_question}
-
-Email Context Summary:
-{summarized_context}
+    # A very long question keeps its start and leaves most of the room for the email
+    question = truncate_text_to_tokens(question, max_tokens // 4)
+    base_prompt = f"""Based on the following excerpts from the email context, please answer this question: {question}
 
-Answer:"""
-            
-            # Final check - if this is still too long, we need to truncate aggressively
-            if num_tokens_from_string(final_prompt) <= max_tokens:
-                try:
-                    completion = client.chat.completions.create(
-                        model="gpt-4",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": final_prompt
-                            }
-                        ],
-                        temperature=0.1
-                    )
-                    return completion.choices[0].message.content.strip()
-                except Exception as e:
-                    print(f"Error getting response: {e}")
-                    return "Sorry, I couldn't process your request due to an error."
-            else:
-                # Last resort: truncate the summarized context to fit
-                base_prompt = f"""Based on the following email context summary, please answer this question: {summarized_question}
-
-Email Context Summary:
+Email Context Excerpts:
 """
-                ending = "\n\nAnswer:"
-                
-                base_tokens = num_tokens_from_string(base_prompt + ending)
-                available_tokens = max_tokens - base_tokens - 100  # Buffer for safety
-                
-                # Truncate the summarized context to fit
-                truncated_context = truncate_text_to_tokens(summarized_context, available_tokens)
-                
-                final_truncated_prompt = base_prompt + truncated_context + ending
-
-                try:
-                    completion = client.chat.completions.create(
-                        model="gpt-4",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": final_truncated_prompt
-                            }
-                        ],
-                        temperature=0.1
-                    )
-                    return completion.choices[0].message.content.strip()
-                except Exception as e:
-                    print(f"Error getting response: {e}")
-                    return "Sorry, I couldn't process your request due to an error."
+    ending = "\n\nAnswer:"
+    available_tokens = max_tokens - num_tokens_from_string(base_prompt + ending, model)
+
+    excerpts = Context_Builder.select_context(email_context, question, available_tokens, model)
+    return base_prompt + excerpts + ending
 
 def truncate_text_to_tokens(text, max_tokens):
     """
@@ -443,25 +942,9 @@ def truncate_text_to_tokens(text, max_tokens):
         max_tokens (int): Maximum number of tokens allowed
         
     Returns:
-        str: Truncated text that fits within the token limit
+        str: The longest prefix of the text that fits within the token limit
     """
-    if num_tokens_from_string(text) <= max_tokens:
-        return text
-    
-    # Rough approximation: 4 characters per token
-    estimated_chars = max_tokens * 4
-    
-    # Start with rough truncation
-    truncated = text[:estimated_chars]
-    
-    # Refine by checking actual token count and adjusting
-    max_iterations = 100
-    iteration_count = 0
-    while num_tokens_from_string(truncated) > max_tokens and len(truncated) > 0 and iteration_count < max_iterations:
-        truncated = truncated[:int(len(truncated) * 0.9)]
-        iteration_count += 1
-    
-    return truncated
+    return Text_Chunker.truncate_text(text, max_tokens)
 
 '''
 def get_response(message):
@@ -0,0 +1,395 @@
+"""
+Build the unread-mail digest through the OpenAI Batch API and email it to yourself, for
+scheduled runs (such as a nightly cron job) where nobody is waiting on the result.
+
+Usage:
+    python Batch_Digest.py [--poll SECONDS]
+
+The digest is made the same way as online, with the calls that make up nearly all of the
+work sent ahead of time as batch jobs, at the Batch API's lower price and under its own
+rate limits: the GPT cleaning of plain text bodies the local rules are unsure about (when
+Gmail_Interface.LLM_CLEAN_FALLBACK is on), and the leaf summaries the digest asks for.
+Batch results go into the completion cache, where the usual online code then finds them;
+only the calls that depend on them, such as the few reduce calls on top, are sent online.
+An online digest of the same emails later on is answered from the same cache and summary
+tree. Progress is saved to STATE_PATH after every step, so a run that crashes or is
+stopped picks up where it left off the next time it starts, polling batches it already
+submitted instead of sending them again, and a digest that could not be emailed is sent
+on the next run.
+
+Every call goes through the LLM_Backend backend. With LLM_BACKEND=local the whole pipeline,
+batch jobs included, runs against LLM_Backend.LocalBackend without touching the network,
+and OPENAI_BASE_URL points the OpenAI backend at any other server that stands in for the API.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from openai.types.chat import ChatCompletion
+import AI_API
+import Gmail_Interface
+import LLM_Backend
+import LLM_Cache
+import Message_Store
+import Telemetry
+
+# Where an unfinished run keeps its progress
+STATE_PATH = 'batch_digest_state.json'
+
+# Seconds between status checks on submitted batches
+POLL_SECONDS = 60
+
+# The Batch API takes at most this many requests in one batch
+MAX_BATCH_REQUESTS = 50000
+
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+
+# Batch statuses that will not change any more
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def load_state(path=STATE_PATH):
+    """
+    Returns:
+        dict: The saved state of an unfinished run, or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(state, path=STATE_PATH):
+    # Written to a temporary file and moved into place, so a crash never leaves half a state
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temporary_path, path)
+
+def new_state(emails):
+    """
+    Args:
+        emails (list): Email objects, or (Gmail message, parse_message_chunk record) pairs
+            for messages whose body still needs the GPT cleaner
+
+    Returns:
+        dict: The state a run starts from, holding everything it needs from the emails
+    """
+    return {
+        'run_id': uuid.uuid4().hex,
+        'phase': 'clean',
+        'batches': [],
+        'emails': [
+            {'pending': list(email)} if isinstance(email, tuple) else email_state(email)
+            for email in emails
+        ],
+    }
+
+def email_state(email):
+    return {'sender': email.sender, 'subject': email.subject, 'text': email.text,
+            'token_count': email.token_count, 'message_id': email.message_id,
+            'internal_date': email.internal_date}
+
+def state_emails(state):
+    """
+    Returns:
+        list: Email objects for every email of a run that has been through the clean phase
+    """
+    return [Gmail_Interface.Email(email['sender'], email['subject'], text=email['text'],
+                                  token_count=email['token_count'], message_id=email['message_id'],
+                                  internal_date=email['internal_date'])
+            for email in state['emails']]
+
+def fetch_unread(service, store):
+    """
+    Load the unread emails for a new run without any OpenAI call. Messages the store has
+    come from it. The rest are downloaded, cleaned locally and saved to it, except those
+    whose body is waiting on the GPT cleaner, which the clean phase finishes.
+
+    Returns:
+        list: Email objects, and (Gmail message, record) pairs for the waiting messages, in
+            the order Gmail lists them
+    """
+    msg_ids = list(Gmail_Interface.iter_message_ids(service))
+    cached = store.get_emails(msg_ids)
+    missing = [msg_id for msg_id in msg_ids if msg_id not in cached]
+
+    fetched = {}
+    ready = []
+    for message, record in Gmail_Interface.iter_parsed_records(Gmail_Interface.iter_messages(service, missing)):
+        if record[4] is not None:
+            fetched[message['id']] = (message, record)
+        else:
+            ready.append((message, record))
+    parsed = list(Gmail_Interface.emails_from_records(ready))
+    store.save_messages(parsed)
+    fetched.update((message['id'], email) for message, email in parsed)
+
+    return [cached.get(msg_id) or fetched[msg_id] for msg_id in msg_ids if msg_id in cached or msg_id in fetched]
+
+def batch_file_path(state, part):
+    return f"batch_digest_{state['run_id']}_{state['phase']}_{part}.jsonl"
+
+def write_batch_file(path, requests):
+    """
+    Write chat completion requests as a Batch API input file, one request per line. Each
+    request's custom_id is its completion cache key, so a result finds its place in the
+    cache even if the run resumes with a different plan.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for request in requests:
+            key = LLM_Cache.cache_key(request, AI_API.PROMPT_VERSION)
+            f.write(json.dumps({"custom_id": key, "method": "POST", "url": ENDPOINT, "body": request},
+                               ensure_ascii=False))
+            f.write("\n")
+
+def find_batch(client, state, part):
+    """
+    Look for a batch this run submitted but crashed before recording.
+
+    Returns:
+        Batch: The batch, or None if it was never created
+    """
+    for batch in client.batches.list(limit=100).data:
+        metadata = batch.metadata or {}
+        if (metadata.get('run_id') == state['run_id'] and metadata.get('phase') == state['phase']
+                and metadata.get('part') == str(part)):
+            return batch
+    return None
+
+def submit_batch(client, state, part, requests):
+    """
+    Returns:
+        Batch: A new batch for requests, tagged with the run, phase and part it belongs to
+    """
+    path = batch_file_path(state, part)
+    write_batch_file(path, requests)
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=ENDPOINT,
+        completion_window=COMPLETION_WINDOW,
+        metadata={'run_id': state['run_id'], 'phase': state['phase'], 'part': str(part)},
+    )
+
+def wait_for_batches(client, batch_ids, poll_seconds):
+    """
+    Returns:
+        list: The final state of each batch
+    """
+    batches = {}
+    while True:
+        for batch_id in batch_ids:
+            if batch_id not in batches or batches[batch_id].status not in FINAL_STATUSES:
+                batches[batch_id] = client.batches.retrieve(batch_id)
+        pending = [batch for batch in batches.values() if batch.status not in FINAL_STATUSES]
+        if not pending:
+            return [batches[batch_id] for batch_id in batch_ids]
+
+        done = sum(batch.request_counts.completed + batch.request_counts.failed
+                   for batch in pending if batch.request_counts)
+        print(f"Waiting on {len(pending)} batch(es), {done} request(s) finished so far...")
+        time.sleep(poll_seconds)
+
+def parse_output(text):
+    """
+    Returns:
+        dict: custom_id -> ChatCompletion, for every request in a batch output file that succeeded
+    """
+    completions = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get('response') or {}
+        if response.get('status_code') == 200 and not result.get('error'):
+            completions[result['custom_id']] = ChatCompletion.model_validate(response['body'])
+    return completions
+
+def run_batches(client, state, requests, stage, poll_seconds, state_path=STATE_PATH):
+    """
+    Send the current phase's requests as batches, or pick up the batches already sent for
+    it, and wait for them to finish. Results go into the completion cache, where the online
+    code finds them, and so does any later online run over the same emails.
+
+    Returns:
+        dict: Cache key -> ChatCompletion, for every request that succeeded
+    """
+    for part, start in enumerate(range(0, len(requests), MAX_BATCH_REQUESTS)):
+        if part < len(state['batches']):
+            continue
+        batch = find_batch(client, state, part) or submit_batch(
+            client, state, part, requests[start:start + MAX_BATCH_REQUESTS])
+        state['batches'].append(batch.id)
+        save_state(state, state_path)
+        print(f"Submitted {state['phase']} batch {batch.id}")
+
+    completions = {}
+    for batch in wait_for_batches(client, state['batches'], poll_seconds):
+        if batch.status != "completed":
+            print(f"Batch {batch.id} ended as {batch.status}; requests without a result fall back")
+        if batch.output_file_id:
+            completions.update(parse_output(client.files.content(batch.output_file_id).text))
+
+    cache = AI_API.get_completion_cache()
+    for key, completion in completions.items():
+        if completion.usage is not None:
+            Telemetry.record("batch", stage, completion.model, "ok",
+                             prompt_tokens=completion.usage.prompt_tokens,
+                             completion_tokens=completion.usage.completion_tokens, batch=True)
+        cache.put(key, completion)
+    return completions
+
+class LeafPlanner(AI_API.AsyncSummarizer):
+    """
+    Walks the same summary path as an online digest, but collects the leaf summary requests
+    it would send instead of sending them. Requests whose text depends on an earlier
+    summary are left for the online run, and so are requests already in the completion cache.
+
+    Each call is answered with PLACEHOLDER and counted as an error, so Summary_Tree never
+    stores what the planner returns.
+    """
+
+    PLACEHOLDER = "\0pending summary\0"
+
+    def __init__(self):
+        super().__init__(async_client=None)
+        self.requests = []
+        self.keys = set()
+
+    async def summarize_text(self, text, stage="reduce"):
+        if not text or text.strip() == "":
+            return ""
+
+        if stage == "leaf_summary" and self.PLACEHOLDER not in text:
+            request = AI_API.summary_request(text, stage)
+            key = LLM_Cache.cache_key(request, AI_API.PROMPT_VERSION)
+            if key not in self.keys and AI_API.get_completion_cache().get(key) is None:
+                self.keys.add(key)
+                self.requests.append(request)
+        self.errors += 1
+        return self.PLACEHOLDER
+
+def plan_leaf_requests(emails):
+    """
+    Returns:
+        list: The leaf summary requests an online digest of the emails would send first
+    """
+    texts, token_counts = AI_API.email_texts(emails)
+
+    async def plan():
+        planner = LeafPlanner()
+        if AI_API.USE_SUMMARY_TREE:
+            await AI_API.get_summary_tree().build(planner, texts, token_counts, summarize_root=False)
+        else:
+            await planner.reduce(texts, token_counts=token_counts)
+        return planner.requests
+
+    return asyncio.run(plan())
+
+def clean_phase(client, state, store, poll_seconds, state_path):
+    emails = state['emails']
+    waiting = [i for i, email in enumerate(emails) if 'pending' in email]
+    budget = AI_API.clean_input_budget()
+    # Texts too long for one cleaning call are split up by the online cleaner
+    texts = {emails[i]['pending'][1][4] for i in waiting}
+    requests = [AI_API.clean_request(text) for text in sorted(texts)
+                if AI_API.num_tokens_from_string(text) <= budget]
+    if requests:
+        run_batches(client, state, requests, "clean", poll_seconds, state_path)
+
+    # The online cleaner finds the batch results in the completion cache, and cleans
+    # anything that failed or did not fit in a batch request itself
+    for i in waiting:
+        message, record = emails[i]['pending']
+        parsed = list(Gmail_Interface.emails_from_records([(message, tuple(record))]))
+        store.save_messages(parsed)
+        emails[i] = email_state(parsed[0][1]) if parsed else None
+    state['emails'] = [email for email in emails if email is not None]
+
+    state.update(phase='leaf', batches=[])
+    save_state(state, state_path)
+
+def leaf_phase(client, state, poll_seconds, state_path):
+    requests = plan_leaf_requests(state_emails(state))
+    if requests:
+        run_batches(client, state, requests, "leaf_summary", poll_seconds, state_path)
+
+    state.update(phase='reduce', batches=[])
+    save_state(state, state_path)
+
+def reduce_phase(state, state_path):
+    # The same digest as online; the leaf summaries come out of the completion cache
+    emails = state_emails(state)
+    digest = AI_API.summarize_Emails(emails) if emails else ""
+    state.update(phase='send', digest=digest)
+    save_state(state, state_path)
+
+def run(client, state, store, poll_seconds=POLL_SECONDS, state_path=STATE_PATH):
+    """
+    Take a run from its saved phase through to the finished digest.
+
+    Args:
+        client: Client for the batch endpoints, from LLM_Backend
+        state (dict): The run, as new_state or load_state returned it
+        store (Message_Store.MessageStore): Where messages cleaned in the clean phase are saved
+
+    Returns:
+        str: The digest
+    """
+    if AI_API.get_completion_cache() is None:
+        raise RuntimeError("Batch results reach the digest through the completion cache; "
+                           "turn on AI_API.USE_COMPLETION_CACHE")
+
+    if state['phase'] == 'clean':
+        clean_phase(client, state, store, poll_seconds, state_path)
+    if state['phase'] == 'leaf':
+        leaf_phase(client, state, poll_seconds, state_path)
+    if state['phase'] == 'reduce':
+        reduce_phase(state, state_path)
+    return state['digest']
+
+def finish(state, state_path=STATE_PATH):
+    """
+    Delete a finished run's state and batch files.
+    """
+    run_id = state['run_id']
+    for name in os.listdir('.'):
+        if name.startswith(f"batch_digest_{run_id}_") and name.endswith(".jsonl"):
+            os.remove(name)
+    os.remove(state_path)
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Email yourself a digest of your unread mail, built with the OpenAI Batch API")
+    parser.add_argument('--poll', type=float, default=POLL_SECONDS, help="Seconds between batch status checks")
+    options = parser.parse_args(args)
+
+    service = Gmail_Interface.start_up()
+    if service is None:
+        return
+
+    store = Message_Store.MessageStore()
+    state = load_state()
+    if state is None:
+        emails = fetch_unread(service, store)
+        print(f"Starting a batch digest of {len(emails)} unread emails")
+        state = new_state(emails)
+        save_state(state)
+    else:
+        print(f"Resuming batch digest {state['run_id']} at the {state['phase']} step")
+
+    digest = run(LLM_Backend.get_backend().batch_client(), state, store, options.poll)
+    # The run stays at the send step until the digest is out, so a failed send is retried next time
+    if Gmail_Interface.send_email(service, digest) is None:
+        print(f"Could not send the digest; it is kept in {STATE_PATH} and sent on the next run")
+    else:
+        finish(state)
+        print("Digest sent")
+    print(Telemetry.report())
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
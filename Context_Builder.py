@@ -0,0 +1,106 @@
+import math
+import re
+from collections import Counter
+import Text_Chunker
+import Token_Counter
+
+# Size of the pieces an email is split into before ranking
+CHUNK_TOKENS = 200
+
+# Marks text left out between two chosen chunks
+GAP = "\n[...]\n"
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'did', 'do', 'does', 'for',
+    'from', 'had', 'has', 'have', 'how', 'i', 'if', 'in', 'is', 'it', 'its', 'me', 'my', 'of',
+    'on', 'or', 'so', 'that', 'the', 'their', 'them', 'they', 'this', 'to', 'was', 'we', 'were',
+    'what', 'when', 'where', 'which', 'who', 'why', 'will', 'with', 'would', 'you', 'your',
+}
+
+
+def words(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+def bm25_scores(chunks, query):
+    """
+    Score each chunk against the query with BM25, treating the chunks as the corpus.
+
+    Returns:
+        list: Score for each chunk, in order
+    """
+    chunk_words = [Counter(words(chunk)) for chunk in chunks]
+    query_words = set(words(query))
+    if not query_words:
+        return [0.0] * len(chunks)
+
+    lengths = [sum(counts.values()) for counts in chunk_words]
+    average_length = sum(lengths) / len(lengths) or 1
+    document_frequency = Counter(word for counts in chunk_words for word in query_words & counts.keys())
+
+    scores = []
+    for counts, length in zip(chunk_words, lengths):
+        score = 0.0
+        for word in query_words:
+            frequency = counts.get(word)
+            if not frequency:
+                continue
+            n = document_frequency[word]
+            idf = math.log(1 + (len(chunks) - n + 0.5) / (n + 0.5))
+            score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+        scores.append(score)
+    return scores
+
+def select_context(text, question, budget, model=Token_Counter.DEFAULT_MODEL, chunk_tokens=CHUNK_TOKENS):
+    """
+    Fit the parts of a text most relevant to a question into a token budget, locally and
+    in a single pass.
+
+    The text is split into chunks on sentence and paragraph boundaries, the chunks are
+    ranked against the question with BM25, and the best ones are packed greedily into the
+    budget. Chosen chunks keep their original order, with a marker where text was left out.
+
+    Args:
+        text (str): Text to draw context from
+        question (str): Question the context should help answer
+        budget (int): Maximum tokens for the returned context
+        model (str): Model whose tokenizer to use
+        chunk_tokens (int): Tokens per chunk
+
+    Returns:
+        str: The selected context
+    """
+    if budget <= 0:
+        return ""
+    if Token_Counter.count_tokens(text, model) <= budget:
+        return text
+
+    chunks = Text_Chunker.chunk_text(text, min(chunk_tokens, budget), model=model)
+    counts = Token_Counter.count_many(chunks, model)
+    scores = bm25_scores(chunks, question)
+    gap_tokens = Token_Counter.count_tokens(GAP, model)
+
+    # Best score first; with equal scores the earlier chunk wins, so the start of the
+    # email (sender, greeting, first paragraph) fills any room left over. Every chunk is
+    # charged a gap marker, and one more is kept for a gap at the end.
+    chosen = []
+    used = gap_tokens
+    for i in sorted(range(len(chunks)), key=lambda i: (-scores[i], i)):
+        cost = counts[i] + gap_tokens
+        if used + cost <= budget:
+            chosen.append(i)
+            used += cost
+
+    chosen.sort()
+    pieces = []
+    for position, i in enumerate(chosen):
+        if position == 0 and i > 0 or position > 0 and i != chosen[position - 1] + 1:
+            pieces.append(GAP)
+        pieces.append(chunks[i])
+    if chosen and chosen[-1] != len(chunks) - 1:
+        pieces.append(GAP)
+    return ''.join(pieces).strip()
@@ -0,0 +1,286 @@
+import asyncio
+import json
+from collections import namedtuple
+import AI_API
+import LLM_Backend
+import Gmail_Interface
+import Text_Chunker
+import Token_Counter
+
+EXTRACTION_PROMPT = """For each email below, extract:
+- summary: one or two sentences on what the email is about
+- action_items: things the reader is asked or expected to do
+- deadlines: dates or times by which something is due, with what is due
+- people: names or addresses of the people involved
+- urgency: "low", "medium" or "high"
+
+Use empty lists when an email has none. Reply with a JSON object whose "emails" array holds
+one entry per email, each with the "id" of the email it describes.
+
+Emails:
+"""
+
+URGENCY_LEVELS = ("low", "medium", "high")
+
+# Schema for the reply, enforced by the API with structured outputs and checked again here
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "emails": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "summary": {"type": "string"},
+                    "action_items": {"type": "array", "items": {"type": "string"}},
+                    "deadlines": {"type": "array", "items": {"type": "string"}},
+                    "people": {"type": "array", "items": {"type": "string"}},
+                    "urgency": {"type": "string", "enum": list(URGENCY_LEVELS)},
+                },
+                "required": ["id", "summary", "action_items", "deadlines", "people", "urgency"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["emails"],
+    "additionalProperties": False,
+}
+
+# Reply tokens reserved for each email's entry
+ENTRY_TOKENS = 300
+
+# Emails extracted in one request, so a bad reply never costs more than this many entries
+MAX_EMAILS_PER_REQUEST = 20
+
+# Requests per email before it is given up on; each retry only resends the failed entries
+MAX_ATTEMPTS = 3
+
+# Extraction requests BatchExtractor keeps in flight at once
+EXTRACTION_CONCURRENCY = 8
+
+# Structured details of one email
+Extraction = namedtuple('Extraction', ['summary', 'action_items', 'deadlines', 'people', 'urgency'])
+
+
+def extraction_version():
+    """
+    Returns:
+        str: Tag stored with each extraction, so a new prompt or model re-extracts
+    """
+    return f"{AI_API.PROMPT_VERSION}:{AI_API.model_for('extract')}"
+
+def input_budget():
+    """
+    Returns:
+        int: Tokens of email text one extraction request can take, next to the prompt and a
+            full request's worth of entries
+    """
+    return min(AI_API.MAX_SUMMARY_INPUT_TOKENS,
+               AI_API.input_budget("extract", EXTRACTION_PROMPT, ENTRY_TOKENS * MAX_EMAILS_PER_REQUEST))
+
+def email_text(email):
+    return Gmail_Interface.prepend_with_title(
+        "From", email.sender, Gmail_Interface.prepend_with_title("Subject", email.subject, email.text))
+
+def extraction_request(texts):
+    """
+    Args:
+        texts (list): Email texts, labelled in the request by their position from 1
+
+    Returns:
+        dict: Chat completion arguments for extracting every text in one call
+    """
+    emails = "\n\n".join(f'<email id="{key}">\n{text}\n</email>' for key, text in enumerate(texts, 1))
+    return {
+        "model": AI_API.model_for("extract"),
+        "messages": [
+            {
+                "role": "user",
+                "content": EXTRACTION_PROMPT + emails
+            }
+        ],
+        "temperature": 0,
+        "max_tokens": ENTRY_TOKENS * len(texts),
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "email_extractions", "strict": True, "schema": EXTRACTION_SCHEMA},
+        },
+    }
+
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def validate_entry(entry):
+    """
+    Returns:
+        Extraction: The entry, if it matches EXTRACTION_SCHEMA, or None
+    """
+    if not isinstance(entry, dict) or not isinstance(entry.get("summary"), str):
+        return None
+    if entry.get("urgency") not in URGENCY_LEVELS:
+        return None
+    if not all(is_string_list(entry.get(field)) for field in ("action_items", "deadlines", "people")):
+        return None
+    return Extraction(entry["summary"].strip(), entry["action_items"], entry["deadlines"],
+                      entry["people"], entry["urgency"])
+
+def parse_entries(content, count):
+    """
+    Pull the valid entries out of a reply to a request for `count` emails. A reply that is
+    not JSON yields nothing, and an entry with an unknown id or a bad field is dropped.
+
+    Returns:
+        dict: Position in the request (from 0) -> Extraction
+    """
+    try:
+        entries = json.loads(content or "").get("emails")
+    except (ValueError, AttributeError):
+        return {}
+    if not isinstance(entries, list):
+        return {}
+
+    extractions = {}
+    for entry in entries:
+        key = str(entry.get("id", "")).strip() if isinstance(entry, dict) else ""
+        if not key.isdigit() or not 1 <= int(key) <= count:
+            continue
+        extraction = validate_entry(entry)
+        if extraction is not None:
+            extractions.setdefault(int(key) - 1, extraction)
+    return extractions
+
+def extraction_text(extraction):
+    """
+    Returns:
+        str: An extraction written out as text, for digests and question context
+    """
+    lines = [f"Summary: {extraction.summary}", f"Urgency: {extraction.urgency}"]
+    for title, items in (("Action items", extraction.action_items), ("Deadlines", extraction.deadlines),
+                         ("People", extraction.people)):
+        if items:
+            lines.append(f"{title}: " + "; ".join(items))
+    return "\n".join(lines)
+
+def to_json(extraction):
+    return json.dumps(extraction._asdict(), ensure_ascii=False)
+
+def from_json(data):
+    return validate_entry(json.loads(data))
+
+def load_stored(emails, store):
+    """
+    Fill in the extraction of every email the store already has one for, without any API call.
+
+    Returns:
+        list: The emails still without an extraction
+    """
+    pending = [email for email in emails if email.extraction is None]
+    if store is None or not pending:
+        return pending
+
+    stored = store.get_extractions([email.message_id for email in pending if email.message_id],
+                                   extraction_version())
+    for email in pending:
+        email.extraction = stored.get(email.message_id)
+    return [email for email in pending if email.extraction is None]
+
+def extract_emails(emails, store=None):
+    """
+    Fill in the extraction of every email that does not have one yet.
+
+    Extractions are looked up in the store first. The rest are packed many to a request
+    and extracted concurrently. Entries missing or invalid in a reply are retried in a
+    smaller request that leaves out the ones that succeeded.
+
+    Args:
+        emails (list): Email objects, with bodies loaded
+        store (Message_Store.MessageStore): Where extractions are kept between runs
+
+    Returns:
+        list: The Extraction of each email, or None where every attempt failed
+    """
+    pending = load_stored(emails, store)
+    if pending:
+        async def run():
+            async with LLM_Backend.get_backend().async_client() as async_client:
+                return await BatchExtractor(async_client).extract([email_text(email) for email in pending])
+
+        extractions = asyncio.run(run())
+        for email, extraction in zip(pending, extractions):
+            email.extraction = extraction
+        if store is not None:
+            store.save_extractions(
+                [(email.message_id, email.extraction) for email in pending
+                 if email.message_id and email.extraction is not None],
+                extraction_version()
+            )
+
+    return [email.extraction for email in emails]
+
+
+class BatchExtractor:
+    """
+    Runs extraction requests with at most `concurrency` in flight. Like AI_API.AsyncSummarizer,
+    it is bound to the event loop of a single asyncio.run.
+    """
+
+    def __init__(self, async_client, concurrency=EXTRACTION_CONCURRENCY):
+        self.client = async_client
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def extract(self, texts):
+        """
+        Returns:
+            list: The Extraction of each text, or None where every attempt failed
+        """
+        budget = input_budget()
+        texts = [Text_Chunker.truncate_text(text, budget) for text in texts]
+        counts = Token_Counter.count_many(texts)
+        # Each email is wrapped in an <email> tag, charged here as a separator
+        wrapper_tokens = AI_API.num_tokens_from_string('\n\n<email id="00">\n\n</email>') + 1
+
+        requests = []
+        for items in Text_Chunker.pack(counts, budget, wrapper_tokens, AI_API.PACKING_STRATEGY):
+            requests.extend(items[start:start + MAX_EMAILS_PER_REQUEST]
+                            for start in range(0, len(items), MAX_EMAILS_PER_REQUEST))
+
+        results = [None] * len(texts)
+        extracted = await asyncio.gather(*(self.extract_request([texts[i] for i in items]) for items in requests))
+        for items, extractions in zip(requests, extracted):
+            for position, extraction in extractions.items():
+                results[items[position]] = extraction
+        return results
+
+    async def extract_request(self, texts):
+        """
+        Extract a group of texts, resending only the ones without a valid entry.
+
+        Returns:
+            dict: Position in texts -> Extraction, for every text that succeeded
+        """
+        results = {}
+        pending = list(range(len(texts)))
+        for attempt in range(MAX_ATTEMPTS):
+            request = extraction_request([texts[i] for i in pending])
+            try:
+                async with self.semaphore:
+                    # A retry of the same emails would only get the cached bad reply back
+                    if attempt == 0:
+                        completion = await AI_API.create_completion_async(self.client, stage="extract", **request)
+                    else:
+                        completion = await AI_API.send_request_async(self.client, request, stage="extract")
+                extractions = parse_entries(completion.choices[0].message.content, len(pending))
+            except Exception as e:
+                print(f"Error extracting emails: {e}")
+                extractions = {}
+
+            for position, extraction in extractions.items():
+                results[pending[position]] = extraction
+            pending = [i for position, i in enumerate(pending) if position not in extractions]
+            if not pending:
+                break
+
+        if pending:
+            print(f"Could not extract {len(pending)} of {len(texts)} emails")
+        return results
@@ -3,27 +3,220 @@ import pickle
 import datetime
 import base64
 import re
+import itertools
+import collections
+import sys
+import functools
+import threading
 import AI_API
+import Rate_Limiter
+import Text_Cleaner
+import HTML_Extractor
+import httplib2
+import google_auth_httplib2
 
 # if I kill load_dotenv, I can kill this line too 
 from dotenv import load_dotenv
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from email.mime.text import MIMEText
+from email.utils import parseaddr
 from google.auth.transport.requests import Request
 
 # Gain full access to Gmail
 SCOPES = ['https://mail.google.com/']
 
+# Gmail accepts up to 100 calls per batch request, but recommends staying at 50 or below
+BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+
+# messages().list returns at most 500 IDs per page
+PAGE_SIZE = 500
+UNREAD_QUERY = 'label:UNREAD label:INBOX'
+
+# Headers requested when listing with format='metadata'
+METADATA_HEADERS = ['From', 'Subject']
+
+# Body part types, and the containers whose direct children are searched for them
+BODY_TYPES = ('text/html', 'text/plain')
+CONTAINER_TYPES = {
+    'multipart/alternative': 'alternative',
+    'multipart/mixed': 'mixed',
+    'multipart/related': 'mixed',
+}
+
+# Bump whenever body extraction or cleaning changes so cached messages get re-parsed
+PARSE_VERSION = 5
+
+# Worker processes for parsing, cleaning and token counting downloaded messages
+# (1 keeps it all in this process), and how many messages go to a worker at a time
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_CHUNK_SIZE = 25
+
+# Which HTML_Extractor backend turns HTML bodies into text ('stdlib' or 'bs4')
+HTML_BACKEND = 'stdlib'
+
+# Send plain text bodies the local cleaner is unsure about to AI_API.clean_email_text
+LLM_CLEAN_FALLBACK = False
+
+# History record types that can move a message in or out of the unread inbox
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+
+# Gmail charges quota units per call against a per-user limit of 250 units per second
+QUOTA_UNITS_PER_SECOND = 250
+QUOTA_COSTS = {
+    'messages.get': 5,
+    'messages.list': 5,
+    'messages.send': 100,
+    'history.list': 2,
+    'getProfile': 1,
+}
+gmail_quota = Rate_Limiter.TokenBucket(QUOTA_UNITS_PER_SECOND)
+
+# Statuses worth retrying with backoff; anything else fails straight away
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+MAX_RETRIES = 5
+
+# 'batch' sends messages().get calls through the batch endpoint, 'concurrent' runs
+# them individually on a thread pool of MAX_CONCURRENCY workers
+FETCH_MODE = 'batch'
+MAX_CONCURRENCY = 10
+
 # Load environment variables
 load_dotenv()
 
+# Result of parse_message: header dict, preferred and alternate body parts, attachment manifest
+ParsedMessage = collections.namedtuple('ParsedMessage', ['headers', 'body_part', 'alternate_part', 'attachments'])
+
 class Email:
-    def __init__(self, sender, subject, text, token_count):
+    # Slots instead of a per-instance __dict__ keep large mailboxes cheap to hold in memory
+    __slots__ = (
+        'sender', 'sender_address', 'subject', 'message_id', 'thread_id', 'internal_date',
+        'label_ids', 'extraction', '_text', '_token_count', '_body_loader',
+    )
+
+    def __init__(self, sender, subject, text=None, token_count=None, message_id=None, body_loader=None,
+                 thread_id=None, internal_date=0, label_ids=()):
         self.sender = sender
+        # Lowercased bare address, shared between every email from the same sender
+        self.sender_address = sys.intern(parseaddr(sender or "")[1].lower())
         self.subject = subject
-        self.text = text
-        self.token_count = token_count
+        self.message_id = message_id
+        self.thread_id = thread_id
+        # Milliseconds since the epoch, as Gmail reports it
+        self.internal_date = int(internal_date or 0)
+        # Labels as of when the message was fetched
+        self.label_ids = intern_labels(label_ids)
+        # Email_Extractor.Extraction, once the email has been through structured extraction
+        self.extraction = None
+        # text and token_count are filled in lazily when only the headers were downloaded
+        self._text = text
+        self._token_count = token_count
+        # Called with this Email the first time its text is needed; expected to call set_body
+        self._body_loader = body_loader
+
+    @property
+    def body_loaded(self):
+        return self._text is not None
+
+    def set_body(self, text, token_count=None):
+        self._text = text or ""
+        self._token_count = token_count
+        self._body_loader = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            body_loader = self._body_loader
+            self._body_loader = None
+            if body_loader is not None:
+                body_loader(self)
+            if self._text is None:
+                self._text = ""
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self.set_body(value)
+
+    @property
+    def token_count(self):
+        if self._token_count is None:
+            text = self.text
+            self._token_count = AI_API.num_tokens_from_string(text) if text else 0
+        return self._token_count
+
+    @token_count.setter
+    def token_count(self, value):
+        self._token_count = value
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self.internal_date / 1000)
+
+_label_tuples = {}
+
+def intern_labels(label_ids):
+    """
+    Return a shared tuple for a set of label IDs, so emails with the same labels share one object.
+    """
+    key = tuple(label_ids or ())
+    return _label_tuples.setdefault(key, tuple(sys.intern(label) for label in key))
+
+# ------------------------------ Quota and Retries ------------------------------
+def is_retryable_error(error):
+    """
+    Check whether a Gmail API error is transient (rate limiting or a server error).
+    Args:
+        error: Exception raised while executing a request
+    Returns:
+        bool: True if the request should be retried after a backoff
+    """
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    # Gmail reports exhausted quota as a 403 with a rate limit reason
+    content = str(error.content)
+    return status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+def execute_with_backoff(request, cost, http=None, max_retries=MAX_RETRIES):
+    """
+    Execute a Gmail API request under the shared quota bucket, retrying transient errors
+    with jittered exponential backoff.
+    Args:
+        request: googleapiclient HttpRequest
+        cost (int): Quota units the call is charged (see QUOTA_COSTS)
+        http: Optional Http object to execute on, for use from worker threads
+        max_retries (int): Retries allowed after the first attempt
+    Returns:
+        dict: The API response
+    """
+    def attempt():
+        gmail_quota.acquire(cost)
+        if http is not None:
+            return request.execute(http=http)
+        return request.execute()
+
+    return Rate_Limiter.retry_with_backoff(attempt, is_retryable_error, max_retries)
+
+_thread_local = threading.local()
+
+def thread_http(service):
+    """
+    httplib2 connections are not thread-safe, so give each worker thread its own
+    authorized Http object built from the service's credentials.
+    """
+    if getattr(_thread_local, 'service', None) is not service:
+        _thread_local.http = google_auth_httplib2.AuthorizedHttp(
+            service._http.credentials, http=httplib2.Http()
+        )
+        _thread_local.service = service
+    return _thread_local.http
 
 # ------------------------------Getting Text from email ------------------------------
 def get_text_from_part(part, cond):
@@ -139,66 +332,146 @@ def get_plain_text_body(message, cond):
     return mess
 
 def plain_clean(text):
-    text = AI_API.clean_email_text(text)
-    return text
+    cleaned, confident = Text_Cleaner.clean_plain_text(text)
+    if not confident and LLM_CLEAN_FALLBACK:
+        return AI_API.clean_email_text(text)
+    return cleaned
 
-def html_clean(text):
-    from bs4 import BeautifulSoup
-    
-    # Parse HTML with BeautifulSoup
-    soup = BeautifulSoup(text, 'html.parser')
-    
-    # Remove images
-    for img in soup.find_all('img'):
-        img.decompose()
-        
-    # Remove style tags and their contents
-    for style in soup.find_all('style'):
-        style.decompose()
-        
-    # Remove script tags and their contents  
-    for script in soup.find_all('script'):
-        script.decompose()
-        
-    # Remove all attributes from remaining tags except href on links
-    for tag in soup.find_all(True):
-        if tag.name == 'a':
-            href = tag.get('href', None)
-            tag.attrs = {'href': href} if href else {}
-        else:
-            tag.attrs = {}
-    
+def html_clean(text, backend=None):
     # Get text content, preserving some whitespace/structure
-    text = soup.get_text(separator=' ', strip=True)
+    text = HTML_Extractor.html_to_text(text, backend or HTML_BACKEND)
 
     '''text = AI_API.clean_email_text(text)'''
     return text
 
-def get_clean_plain_text_body(message):
+def get_headers(message):
     """
-    Extract and clean the plain text body from a Gmail message.
-    
+    Collect a Gmail message's headers into a dict, keeping the first value of each name.
     Args:
         message: Gmail message object containing payload data
     Returns:
-        str: Cleaned plain text body of the message, or None if not found
+        dict: Header name -> value
+    """
+    headers = {}
+    for header in message.get('payload', {}).get('headers', []):
+        headers.setdefault(header.get('name'), header.get('value'))
+    return headers
+
+def parse_message(message):
     """
-    raw_text = get_plain_text_body(message, 'text/html')
+    Walk a Gmail message payload once and collect everything needed from it.
+    Body parts are picked with the same precedence as get_plain_text_body: the payload
+    itself, then the first match directly under a multipart/alternative, then the first
+    match directly under a multipart/mixed or multipart/related. HTML is preferred.
+    Args:
+        message: Gmail message object containing payload data
+    Returns:
+        ParsedMessage: headers dict, preferred body part, alternate body part (or None),
+            and a list of attachment dicts (filename, mimeType, size, attachmentId, partId)
+    """
+    payload = message.get('payload', {})
+    # (mimeType, where it was found) -> first matching part
+    found = {}
+    attachments = []
 
+    if payload.get('mimeType') in BODY_TYPES and payload.get('body', {}).get('data'):
+        found[(payload['mimeType'], 'payload')] = payload
 
+    # Pre-order walk, the same order the find_first_* helpers search in
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        body = part.get('body', {})
+        if part.get('filename') and body.get('attachmentId'):
+            attachments.append({
+                'filename': part['filename'],
+                'mimeType': part.get('mimeType'),
+                'size': body.get('size', 0),
+                'attachmentId': body['attachmentId'],
+                'partId': part.get('partId'),
+            })
 
-    if raw_text is None:
-        raw_text = get_plain_text_body(message, 'text/plain')
-        if raw_text is None:
-            return None
-        else:
-            return plain_clean(raw_text)
+        children = part.get('parts', [])
+        container = CONTAINER_TYPES.get(part.get('mimeType'))
+        if container:
+            for child in children:
+                if child.get('mimeType') in BODY_TYPES and child.get('body', {}).get('data'):
+                    found.setdefault((child['mimeType'], container), child)
+        stack.extend(reversed(children))
+
+    def pick(mime_type):
+        for where in ('payload', 'alternative', 'mixed'):
+            part = found.get((mime_type, where))
+            if part is not None:
+                return part
+        return None
+
+    html_part = pick('text/html')
+    plain_part = pick('text/plain')
+    if html_part is not None:
+        body_part, alternate_part = html_part, plain_part
     else:
-        return html_clean(raw_text)
+        body_part, alternate_part = plain_part, None
+
+    return ParsedMessage(get_headers(message), body_part, alternate_part, attachments)
+
+def decode_part_text(part):
+    """
+    Decode the base64url body data of a message part.
+    """
+    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+
+def clean_parsed_body(parsed):
+    """
+    Decode and clean the preferred body part of a ParsedMessage.
+    Args:
+        parsed: ParsedMessage returned by parse_message
+    Returns:
+        str: Cleaned body text, or None if the message has no text body
+    """
+    text, fallback_text = clean_parsed_body_locally(parsed, HTML_BACKEND, LLM_CLEAN_FALLBACK)
+    if fallback_text is not None:
+        return AI_API.clean_email_text(fallback_text)
+    return text
+
+def clean_parsed_body_locally(parsed, html_backend, llm_clean_fallback):
+    """
+    Decode and clean the preferred body part of a ParsedMessage without any API call.
+    Args:
+        parsed: ParsedMessage returned by parse_message
+        html_backend (str): HTML_Extractor backend for HTML bodies
+        llm_clean_fallback (bool): Whether plain text the rules are unsure about goes to GPT
+    Returns:
+        tuple: (cleaned body text or None if the message has no text body, and the raw
+            text to clean with AI_API.clean_email_text instead, or None)
+    """
+    if parsed.body_part is None:
+        return None, None
+
+    raw_text = decode_part_text(parsed.body_part)
+    if parsed.body_part['mimeType'] == 'text/html':
+        return html_clean(raw_text, html_backend), None
+
+    cleaned, confident = Text_Cleaner.clean_plain_text(raw_text)
+    # Only pay for a GPT call when the rules weren't sure, and only if that's been opted into
+    if not confident and llm_clean_fallback:
+        return cleaned, raw_text
+    return cleaned, None
+
+def get_clean_plain_text_body(message):
+    """
+    Extract and clean the plain text body from a Gmail message.
+    
+    Args:
+        message: Gmail message object containing payload data
+    Returns:
+        str: Cleaned plain text body of the message, or None if not found
+    """
+    return clean_parsed_body(parse_message(message))
 
 # ------------------------------ Helper Functions ------------------------------
 def get_own_email_address(service):
-    profile = service.users().getProfile(userId='me').execute()
+    profile = execute_with_backoff(service.users().getProfile(userId='me'), QUOTA_COSTS['getProfile'])
     return profile['emailAddress']
 
 def get_sender_from_message(message):
@@ -231,6 +504,35 @@ def get_subject_from_message(message):
             return header.get('value')
     return None
 
+def iter_message_ids(service, query=UNREAD_QUERY, page_size=PAGE_SIZE):
+    """
+    Lazily walk every page of messages().list and yield message IDs as each page arrives.
+    Args:
+        service: Gmail API service instance
+        query (str): Gmail search query (default: unread inbox messages)
+        page_size (int): Number of IDs requested per page (Gmail allows at most 500)
+    Yields:
+        str: Gmail message ID
+    """
+    page_token = None
+    while True:
+        results = execute_with_backoff(
+            service.users().messages().list(
+                userId='me',
+                q=query,
+                maxResults=page_size,
+                pageToken=page_token
+            ),
+            QUOTA_COSTS['messages.list']
+        )
+
+        for msg in results.get('messages', []):
+            yield msg['id']
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
 def count_unread_emails(service):
     """
     Count the number of unread emails in the Gmail inbox.
@@ -240,15 +542,8 @@ def count_unread_emails(service):
         int: Number of unread emails found
     """
     try:
-        # Query for unread messages
-        results = service.users().messages().list(
-            userId='me',
-            q='is:unread'
-        ).execute()
-        
-        # Get the messages list, return 0 if none found
-        messages = results.get('messages', [])
-        return len(messages)
+        # Walk every page so large inboxes aren't capped at the first page
+        return sum(1 for _ in iter_message_ids(service, query='is:unread'))
         
     except Exception as e:
         print(f"Error counting unread emails: {e}")
@@ -260,6 +555,7 @@ def send_email(service, message_text):
 
     :param service: Authorized Gmail API service instance
     :param message_text: Email body
+    :return: The sent message, or None if it could not be sent
     """
     # 1. Create MIME message
     message = MIMEText(message_text)
@@ -276,30 +572,277 @@ def send_email(service, message_text):
 
     # 4. Send the message
     try:
-        sent_message = service.users().messages().send(userId='me', body=create_message).execute()
-        return
+        sent_message = execute_with_backoff(
+            service.users().messages().send(userId='me', body=create_message),
+            QUOTA_COSTS['messages.send']
+        )
+        return sent_message
     except Exception as e:
-        return
+        print(f"Error sending email: {e}")
+        return None
+
+
+def iter_unique(items):
+    """
+    Yield each item the first time it appears, preserving order.
+    """
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+def message_get_request(service, msg_id, msg_format='full'):
+    """
+    Build a messages().get request, asking only for METADATA_HEADERS when msg_format is 'metadata'.
+    """
+    if msg_format == 'metadata':
+        return service.users().messages().get(
+            userId='me', id=msg_id, format='metadata', metadataHeaders=METADATA_HEADERS
+        )
+    return service.users().messages().get(userId='me', id=msg_id, format=msg_format)
+
+def fetch_message(service, msg_id, msg_format='full', http=None, max_retries=MAX_RETRIES):
+    """
+    Fetch a single Gmail message with quota limiting and backoff.
+    Args:
+        service: Gmail API service instance
+        msg_id (str): Message ID to fetch
+        msg_format (str): 'full' for bodies, or 'metadata' for just METADATA_HEADERS
+        http: Optional Http object to execute on, for use from worker threads
+        max_retries (int): Retries allowed after the first attempt
+    Returns:
+        dict: Gmail message, or None if it could not be fetched
+    """
+    try:
+        return execute_with_backoff(
+            message_get_request(service, msg_id, msg_format), QUOTA_COSTS['messages.get'], http, max_retries
+        )
+    except Exception as e:
+        print(f"Error fetching message {msg_id}: {e}")
+        return None
+
+def fetch_message_batch(service, msg_ids, max_retries=MAX_RETRIES, msg_format='full'):
+    """
+    Fetch one batch of Gmail messages through the batch endpoint.
+    Args:
+        service: Gmail API service instance
+        msg_ids (list): Unique message IDs to fetch, at most MAX_BATCH_SIZE of them
+        max_retries (int): Retries allowed for a failed sub-request, which is retried on its own
+        msg_format (str): 'full' for bodies, or 'metadata' for just METADATA_HEADERS
+    Returns:
+        list: Message dicts in the same order as msg_ids, skipping any that could not be fetched
+    """
+    fetched = {}
+    failed = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            failed.append(request_id)
+        else:
+            fetched[request_id] = response
+
+    batch = service.new_batch_http_request(callback=callback)
+    for msg_id in msg_ids:
+        batch.add(message_get_request(service, msg_id, msg_format), request_id=msg_id)
+    try:
+        # Every sub-request in a batch is charged quota on its own
+        gmail_quota.acquire(QUOTA_COSTS['messages.get'] * len(msg_ids))
+        batch.execute()
+    except Exception as e:
+        # The whole batch failed, so every message in it goes through the retry path
+        print(f"Error executing batch request: {e}")
+        failed = [msg_id for msg_id in msg_ids if msg_id not in fetched]
+
+    # Retry failed sub-requests one at a time so a single bad message can't sink a whole batch
+    for msg_id in failed:
+        message = fetch_message(service, msg_id, msg_format, max_retries=max_retries)
+        if message is not None:
+            fetched[msg_id] = message
+
+    return [fetched[msg_id] for msg_id in msg_ids if msg_id in fetched]
+
+def iter_messages_batched(service, msg_ids, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, msg_format='full'):
+    """
+    Lazily fetch Gmail messages in batches, yielding each batch as soon as it arrives.
+    Args:
+        service: Gmail API service instance
+        msg_ids (iterable): Message IDs to fetch; may itself be a generator
+        batch_size (int): Number of sub-requests per batch (Gmail allows at most 100)
+        max_retries (int): Retries allowed for a failed sub-request, which is retried on its own
+        msg_format (str): 'full' for bodies, or 'metadata' for just METADATA_HEADERS
+    Yields:
+        dict: Gmail message, in the order the IDs were listed
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    # Batch request IDs have to be unique, so drop duplicates but keep the listing order
+    msg_ids = iter_unique(msg_ids)
+
+    while True:
+        chunk = list(itertools.islice(msg_ids, batch_size))
+        if not chunk:
+            return
+        yield from fetch_message_batch(service, chunk, max_retries, msg_format)
+
+def get_messages_batched(service, msg_ids, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES):
+    """
+    Fetch full Gmail messages using the batch endpoint instead of one request per message.
+    Args:
+        service: Gmail API service instance
+        msg_ids (iterable): Message IDs to fetch, in the order they should be returned
+        batch_size (int): Number of sub-requests per batch (Gmail allows at most 100)
+        max_retries (int): Retries allowed for a failed sub-request, which is retried on its own
+    Returns:
+        list: Message dicts in the same order as msg_ids, skipping any that could not be fetched
+    """
+    return list(iter_messages_batched(service, msg_ids, batch_size, max_retries))
+
+def iter_messages_concurrent(service, msg_ids, max_workers=MAX_CONCURRENCY, msg_format='full'):
+    """
+    Lazily fetch Gmail messages with individual requests spread over a thread pool.
+    Every call goes through the shared quota bucket, so the pool can run flat out on
+    a large backfill without tripping Gmail's per-user rate limit.
+    Args:
+        service: Gmail API service instance
+        msg_ids (iterable): Message IDs to fetch; may itself be a generator
+        max_workers (int): Maximum number of requests in flight at once
+        msg_format (str): 'full' for bodies, or 'metadata' for just METADATA_HEADERS
+    Yields:
+        dict: Gmail message, in the order the IDs were listed
+    """
+    def fetch(msg_id):
+        return fetch_message(service, msg_id, msg_format, thread_http(service))
+
+    msg_ids = iter_unique(msg_ids)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            chunk = list(itertools.islice(msg_ids, PAGE_SIZE))
+            if not chunk:
+                return
+            for message in executor.map(fetch, chunk):
+                if message is not None:
+                    yield message
+
+def iter_messages(service, msg_ids, batch_size=BATCH_SIZE, msg_format='full'):
+    """
+    Lazily fetch Gmail messages using the configured FETCH_MODE.
+    Args:
+        service: Gmail API service instance
+        msg_ids (iterable): Message IDs to fetch; may itself be a generator
+        batch_size (int): Number of sub-requests per batch in 'batch' mode
+        msg_format (str): 'full' for bodies, or 'metadata' for just METADATA_HEADERS
+    Yields:
+        dict: Gmail message, in the order the IDs were listed
+    """
+    if FETCH_MODE == 'concurrent':
+        return iter_messages_concurrent(service, msg_ids, msg_format=msg_format)
+    return iter_messages_batched(service, msg_ids, batch_size, msg_format=msg_format)
+
+def iter_unread_emails(service, max_results=None, batch_size=BATCH_SIZE):
+    """
+    Stream every unread inbox message, walking all list pages and fetching bodies in batches.
+    Args:
+        service: Gmail API service instance
+        max_results (int): Optional cap on the number of messages (default: no cap)
+        batch_size (int): Number of messages fetched per batch request
+    Yields:
+        dict: Full Gmail message
+    """
+    msg_ids = iter_message_ids(service)
+    if max_results is not None:
+        msg_ids = itertools.islice(msg_ids, max_results)
+
+    yield from iter_messages(service, msg_ids, batch_size)
+
+def get_unread_emails(service, max_results=None, batch_size=BATCH_SIZE):
+    return list(iter_unread_emails(service, max_results, batch_size))
 
+# ------------------------------ Incremental Sync ------------------------------
+def get_current_history_id(service):
+    """
+    Get the mailbox's current history ID, the starting point for the next incremental sync.
+    Args:
+        service: Gmail API service instance
+    Returns:
+        str: Current history ID
+    """
+    profile = execute_with_backoff(service.users().getProfile(userId='me'), QUOTA_COSTS['getProfile'])
+    return profile['historyId']
+
+def is_unread_inbox(label_ids):
+    """
+    Check whether a message with the given labels belongs in the unread inbox.
+    Args:
+        label_ids (list): Gmail label IDs on the message
+    Returns:
+        bool: True if the message is both unread and in the inbox
+    """
+    label_ids = label_ids or []
+    return 'UNREAD' in label_ids and 'INBOX' in label_ids
 
-def get_unread_emails(service, max_results=100):
-    # List unread messages in the inbox
-    results = service.users().messages().list(
-        userId='me',
-        q='label:UNREAD label:INBOX',
-        maxResults=max_results
-    ).execute()
+def iter_history(service, start_history_id, page_size=PAGE_SIZE):
+    """
+    Walk every page of users().history().list starting at start_history_id.
+    Raises googleapiclient.errors.HttpError (status 404) if the history ID has expired.
+    Args:
+        service: Gmail API service instance
+        start_history_id (str): History ID saved by the previous sync
+        page_size (int): Number of history records requested per page
+    Yields:
+        dict: Either a history record, or {'historyId': ...} once the last page is read
+    """
+    page_token = None
+    while True:
+        results = execute_with_backoff(
+            service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=HISTORY_TYPES,
+                maxResults=page_size,
+                pageToken=page_token
+            ),
+            QUOTA_COSTS['history.list']
+        )
+
+        for record in results.get('history', []):
+            yield record
 
-    messages = results.get('messages', [])
-    emails = []
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            yield {'historyId': results.get('historyId', start_history_id)}
+            return
+
+def get_history_changes(service, start_history_id):
+    """
+    Collapse the mailbox history since start_history_id into the final unread-inbox
+    membership of every message that changed.
+    Raises googleapiclient.errors.HttpError (status 404) if the history ID has expired.
+    Args:
+        service: Gmail API service instance
+        start_history_id (str): History ID saved by the previous sync
+    Returns:
+        tuple: (dict mapping message ID to True if it is now an unread inbox message and
+               False if it no longer is, new history ID to save for the next sync)
+    """
+    changes = {}
+    new_history_id = start_history_id
 
-    for msg in messages:
-        msg_id = msg['id']
-        msg_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    for record in iter_history(service, start_history_id):
+        if 'id' not in record:
+            new_history_id = record['historyId']
+            continue
 
-        emails.append(msg_data)
+        # Records are in chronological order, so later changes overwrite earlier ones
+        for added in record.get('messagesAdded', []):
+            message = added['message']
+            changes[message['id']] = is_unread_inbox(message.get('labelIds'))
+        for relabeled in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+            message = relabeled['message']
+            changes[message['id']] = is_unread_inbox(message.get('labelIds'))
+        for deleted in record.get('messagesDeleted', []):
+            changes[deleted['message']['id']] = False
 
-    return emails
+    return changes, new_history_id
 
 def prepend_with_title(title, title_content, body_text):
     """
@@ -321,53 +864,331 @@ def prepend_with_title(title, title_content, body_text):
     return f"{title}: {title_content}\n{body_text}"
 
 
-def get_unread_email_objects(service, max_results=100):
+def email_object_from_message(message):
     """
-    Get unread emails and return them as Email objects with subject, sender, and body text.
+    Build an Email object from a full Gmail message.
     
     Args:
-        service: Authorized Gmail API service instance
-        max_results (int): Maximum number of emails to retrieve (default: 100)
+        message: Gmail message object containing payload data
         
     Returns:
-        list: List of Email objects containing sender, subject, text, and token_count
+        Email: Email object containing sender, subject, text, and token_count
     """
-    # Get unread emails using existing function
-    unread_emails = get_unread_emails(service, max_results)
+    # Walk the payload once for headers and body
+    parsed = parse_message(message)
+    sender = parsed.headers.get('From')
+    subject = parsed.headers.get('Subject')
+    body_text = clean_parsed_body(parsed)
     
-    email_objects = []
+    # Calculate token count for the body text
+    token_count = 0
+    if body_text:
+        token_count = AI_API.num_tokens_from_string(body_text)
+    
+    return Email(
+        sender=sender or "Unknown Sender",
+        subject=subject or "No Subject",
+        text=body_text or "",
+        token_count=token_count,
+        **message_fields(message)
+    )
+
+def message_fields(message):
+    """
+    Pull the Email fields that sit at the top level of a Gmail message rather than in its payload.
+    
+    Args:
+        message: Gmail message object
+        
+    Returns:
+        dict: message_id, thread_id, internal_date and label_ids keyword arguments for Email
+    """
+    return {
+        'message_id': message.get('id'),
+        'thread_id': message.get('threadId'),
+        'internal_date': message.get('internalDate', 0),
+        'label_ids': message.get('labelIds', ()),
+    }
+
+def parse_message_chunk(messages, html_backend, llm_clean_fallback):
+    """
+    Parse and clean a chunk of raw Gmail messages into compact records. Runs inside the
+    parse worker processes, so it only returns plain tuples and never raises. The settings
+    are passed in rather than read from this module, which a worker may have imported
+    fresh, and no API calls are made here: plain text that needs the GPT cleaner is handed
+    back for the parent process to clean, under its shared rate limits and telemetry.
     
-    for message in unread_emails:
+    Args:
+        messages (list): Full Gmail message dicts
+        html_backend (str): HTML_BACKEND of the parent process
+        llm_clean_fallback (bool): LLM_CLEAN_FALLBACK of the parent process
+        
+    Returns:
+        list: (sender, subject, text, token_count, fallback_text, error) per message, where
+            fallback_text is raw text still to be cleaned with GPT (text and token_count are
+            then None), and error is None on success and a description of the failure otherwise
+    """
+    records = []
+    for message in messages:
         try:
-            # Extract sender using existing function
-            sender = get_sender_from_message(message)
-            
-            # Extract subject using existing function
-            subject = get_subject_from_message(message)
-            
-            # Extract clean body text using existing function
-            body_text = get_clean_plain_text_body(message)
-            
-            # Calculate token count for the body text
-            token_count = 0
-            if body_text:
-                token_count = AI_API.num_tokens_from_string(body_text)
-            
-            # Create Email object
-            email_obj = Email(
-                sender=sender or "Unknown Sender",
-                subject=subject or "No Subject",
-                text=body_text or "",
-                token_count=token_count
-            )
-            
-            email_objects.append(email_obj)
-            
+            parsed = parse_message(message)
+            text, fallback_text = clean_parsed_body_locally(parsed, html_backend, llm_clean_fallback)
+            if fallback_text is not None:
+                text, token_count = None, None
+            else:
+                text = text or ""
+                token_count = AI_API.num_tokens_from_string(text) if text else 0
+            records.append((parsed.headers.get('From') or "Unknown Sender",
+                            parsed.headers.get('Subject') or "No Subject",
+                            text, token_count, fallback_text, None))
         except Exception as e:
-            print(f"Error processing email: {e}")
+            records.append((None, None, None, None, None, str(e)))
+    return records
+
+_parse_pool = None
+
+def get_parse_pool(workers):
+    """
+    Start the shared parse worker pool the first time it is needed and reuse it afterwards.
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=workers)
+    return _parse_pool
+
+def iter_parsed_emails(messages, workers=PARSE_WORKERS, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parse, clean and token-count raw Gmail messages on a pool of worker processes.
+    Messages are read in windows of workers * chunk_size; while the workers handle one
+    window, the next one is pulled from `messages`, so downloading and parsing overlap.
+    A message that fails to parse is reported and skipped without affecting the rest.
+    
+    Args:
+        messages: Iterable of full Gmail messages; may itself be a generator
+        workers (int): Number of worker processes; 1 parses in this process
+        chunk_size (int): Number of messages sent to a worker at a time
+        
+    Yields:
+        tuple: (Gmail message, Email object), in input order
+    """
+    yield from emails_from_records(iter_parsed_records(messages, workers, chunk_size))
+
+def iter_parsed_records(messages, workers=PARSE_WORKERS, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    The local half of iter_parsed_emails: parse and clean messages on the worker pool
+    without any API call, leaving bodies that need the GPT cleaner flagged in their records.
+    
+    Yields:
+        tuple: (Gmail message, record as returned by parse_message_chunk), in input order
+    """
+    messages = iter(messages)
+    window_size = max(1, workers) * chunk_size
+    in_flight = None
+
+    while True:
+        window = list(itertools.islice(messages, window_size))
+
+        if in_flight is not None:
+            previous_window, futures = in_flight
+            records = [record for future in futures for record in future.result()]
+            yield from zip(previous_window, records)
+            in_flight = None
+
+        if not window:
+            return
+
+        # Small windows aren't worth the round trip to another process
+        if workers <= 1 or len(window) <= chunk_size:
+            yield from zip(window, parse_message_chunk(window, HTML_BACKEND, LLM_CLEAN_FALLBACK))
+            continue
+
+        pool = get_parse_pool(workers)
+        futures = [
+            pool.submit(parse_message_chunk, window[start:start + chunk_size], HTML_BACKEND, LLM_CLEAN_FALLBACK)
+            for start in range(0, len(window), chunk_size)
+        ]
+        in_flight = (window, futures)
+
+def emails_from_records(messages_and_records):
+    """
+    Turn parse_message_chunk records into Email objects, cleaning any flagged body with
+    the GPT cleaner here in the calling process. Records of messages that failed to parse
+    are reported and skipped.
+    
+    Args:
+        messages_and_records: Iterable of (Gmail message, record) pairs
+        
+    Yields:
+        tuple: (Gmail message, Email object)
+    """
+    for message, (sender, subject, text, token_count, fallback_text, error) in messages_and_records:
+        if error is not None:
+            print(f"Error processing email: {error}")
             continue
+        if fallback_text is not None:
+            text = AI_API.clean_email_text(fallback_text)
+            token_count = AI_API.num_tokens_from_string(text) if text else 0
+        yield message, Email(
+            sender=sender,
+            subject=subject,
+            text=text,
+            token_count=token_count,
+            **message_fields(message)
+        )
+
+def email_header_object_from_message(message, body_loader=None):
+    """
+    Build an Email object from a metadata-only Gmail message, leaving the body to be loaded later.
+    
+    Args:
+        message: Gmail message fetched with format='metadata'
+        body_loader: Called with the Email the first time its text is needed
+        
+    Returns:
+        Email: Email object whose text and token_count are loaded on demand
+    """
+    headers = get_headers(message)
+    return Email(
+        sender=headers.get('From') or "Unknown Sender",
+        subject=headers.get('Subject') or "No Subject",
+        body_loader=body_loader,
+        **message_fields(message)
+    )
+
+def load_email_body(service, email, store=None):
+    """
+    Download, clean and attach the body of a single header-only Email.
+    
+    Args:
+        service: Authorized Gmail API service instance
+        email: Email object with a message_id
+        store: Optional Message_Store.MessageStore to save the full message into
+    """
+    message = execute_with_backoff(message_get_request(service, email.message_id), QUOTA_COSTS['messages.get'])
+    email.set_body(get_clean_plain_text_body(message))
+    if store is not None:
+        store.save_messages([(message, email)])
+
+def hydrate_email_bodies(service, email_objects, store=None, batch_size=BATCH_SIZE):
+    """
+    Load the bodies of every header-only Email in one pass of batch requests, rather than
+    one round trip per email the first time each text is read.
     
-    return email_objects
+    Args:
+        service: Authorized Gmail API service instance
+        email_objects: Iterable of Email objects; ones whose body is already loaded are skipped
+        store: Optional Message_Store.MessageStore to save the full messages into
+        batch_size (int): Number of messages fetched per batch request
+    """
+    pending = {
+        email.message_id: email
+        for email in email_objects
+        if not email.body_loaded and email.message_id
+    }
+    loaded = []
+
+    fetched_ids = set()
+
+    def fetched():
+        for message in iter_messages(service, pending, batch_size):
+            fetched_ids.add(message['id'])
+            yield message
+
+    for message, parsed in iter_parsed_emails(fetched()):
+        email = pending[message['id']]
+        email.set_body(parsed.text, parsed.token_count)
+        loaded.append((message, email))
+
+        if store is not None and len(loaded) >= batch_size:
+            store.save_messages(loaded)
+            loaded = []
+
+    if store is not None:
+        store.save_messages(loaded)
+
+    # Downloaded but unparseable messages won't parse any better next time
+    for msg_id in fetched_ids:
+        if not pending[msg_id].body_loaded:
+            pending[msg_id].set_body("")
+
+def iter_email_objects_for_ids(service, msg_ids, store=None, batch_size=BATCH_SIZE, headers_only=False):
+    """
+    Stream Email objects for the given message IDs, serving them from the local message
+    store when possible and only fetching IDs the store has never seen.
+    
+    Args:
+        service: Authorized Gmail API service instance
+        msg_ids: Iterable of Gmail message IDs; may itself be a generator
+        store: Optional Message_Store.MessageStore used as a local cache
+        batch_size (int): Number of messages fetched per batch request
+        headers_only (bool): Fetch only METADATA_HEADERS for uncached messages and load
+            their bodies on demand
+        
+    Yields:
+        Email: Email object, in the order the IDs were given
+    """
+    msg_format = 'metadata' if headers_only else 'full'
+    body_loader = functools.partial(load_email_body, service, store=store)
+
+    msg_ids = iter(msg_ids)
+    while True:
+        chunk = list(itertools.islice(msg_ids, PAGE_SIZE))
+        if not chunk:
+            return
+
+        cached = store.get_emails(chunk) if store is not None else {}
+        missing = [msg_id for msg_id in chunk if msg_id not in cached]
+
+        fetched = {}
+        messages = iter_messages(service, missing, batch_size, msg_format=msg_format)
+        if headers_only:
+            for message in messages:
+                email_obj = email_header_object_from_message(message, body_loader)
+                fetched[email_obj.message_id] = email_obj
+        else:
+            new_messages = list(iter_parsed_emails(messages))
+            fetched.update((email_obj.message_id, email_obj) for _, email_obj in new_messages)
+            if store is not None:
+                store.save_messages(new_messages)
+
+        for msg_id in chunk:
+            email_obj = cached.get(msg_id) or fetched.get(msg_id)
+            if email_obj is not None:
+                yield email_obj
+
+def iter_unread_email_objects(service, max_results=None, store=None, headers_only=False):
+    """
+    Stream unread emails as Email objects, processing each message as its batch arrives.
+    
+    Args:
+        service: Authorized Gmail API service instance
+        max_results (int): Optional cap on the number of emails (default: no cap)
+        store: Optional Message_Store.MessageStore used as a local cache
+        headers_only (bool): Download only sender and subject up front and load bodies on demand
+        
+    Yields:
+        Email: Email object containing sender, subject, text, and token_count
+    """
+    msg_ids = iter_message_ids(service)
+    if max_results is not None:
+        msg_ids = itertools.islice(msg_ids, max_results)
+
+    yield from iter_email_objects_for_ids(service, msg_ids, store, headers_only=headers_only)
+
+def get_unread_email_objects(service, max_results=None, store=None, headers_only=False):
+    """
+    Get unread emails and return them as Email objects with subject, sender, and body text.
+    
+    Args:
+        service: Authorized Gmail API service instance
+        max_results (int): Optional cap on the number of emails (default: no cap)
+        store: Optional Message_Store.MessageStore used as a local cache
+        headers_only (bool): Download only sender and subject up front and load bodies on demand
+        
+    Returns:
+        list: List of Email objects containing sender, subject, text, and token_count
+    """
+    return list(iter_unread_email_objects(service, max_results, store, headers_only))
 
 
 def create_credentials():
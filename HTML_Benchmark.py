@@ -0,0 +1,98 @@
+"""
+Benchmark the HTML_Extractor backends on real email bodies.
+
+Usage:
+    python HTML_Benchmark.py [corpus ...]
+
+Each corpus argument is either a Message_Store database (the HTML bodies of every cached
+message are used) or a directory of .html files. With no arguments the default message
+store is used. Reports throughput in MB/s for each backend, and how many documents came
+out differently from the bs4 backend.
+"""
+import os
+import sqlite3
+import sys
+import time
+import Gmail_Interface
+import HTML_Extractor
+import Message_Store
+
+# Each backend gets at least this many seconds of work so small corpora still give stable numbers
+MIN_SECONDS = 2.0
+
+
+def load_store_corpus(path):
+    """
+    Returns:
+        list: Decoded HTML bodies of every message cached in a Message_Store database
+    """
+    conn = sqlite3.connect(path)
+    documents = []
+    for (raw,) in conn.execute('SELECT raw FROM messages'):
+        parsed = Gmail_Interface.parse_message(Message_Store.decompress_message(raw))
+        if parsed.body_part is not None and parsed.body_part['mimeType'] == 'text/html':
+            documents.append(Gmail_Interface.decode_part_text(parsed.body_part))
+    conn.close()
+    return documents
+
+def load_directory_corpus(path):
+    """
+    Returns:
+        list: Contents of every .html file in the directory
+    """
+    documents = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(('.html', '.htm')):
+            with open(os.path.join(path, name), encoding='utf-8', errors='replace') as f:
+                documents.append(f.read())
+    return documents
+
+def benchmark(backend, documents):
+    """
+    Returns:
+        float: Throughput of the backend over the corpus in MB/s of UTF-8 input
+    """
+    extract = HTML_Extractor.BACKENDS[backend]
+    corpus_bytes = sum(len(document.encode('utf-8')) for document in documents)
+
+    rounds = 0
+    start = time.perf_counter()
+    while True:
+        for document in documents:
+            extract(document)
+        rounds += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_SECONDS:
+            break
+
+    return corpus_bytes * rounds / elapsed / 1_000_000
+
+def main(paths):
+    documents = []
+    for path in paths or [Message_Store.STORE_PATH]:
+        if os.path.isdir(path):
+            documents.extend(load_directory_corpus(path))
+        else:
+            documents.extend(load_store_corpus(path))
+
+    if not documents:
+        print("No HTML bodies found in the corpus")
+        return
+
+    corpus_mb = sum(len(document.encode('utf-8')) for document in documents) / 1_000_000
+    print(f"Corpus: {len(documents)} HTML bodies, {corpus_mb:.2f} MB")
+
+    backends = [name for name in HTML_Extractor.BACKENDS
+                if name != 'bs4' or HTML_Extractor.BeautifulSoup is not None]
+    for backend in backends:
+        print(f"{backend:>8}: {benchmark(backend, documents):8.2f} MB/s")
+
+    if 'bs4' in backends:
+        mismatches = sum(
+            HTML_Extractor.html_to_text(document, 'stdlib') != HTML_Extractor.html_to_text(document, 'bs4')
+            for document in documents
+        )
+        print(f"Output differs from bs4 on {mismatches} of {len(documents)} bodies")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+from html.parser import HTMLParser
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+# Elements whose contents never count as text
+SKIPPED_TAGS = {'script', 'style', 'template'}
+
+# Elements that never have children, so they are never left open
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+    'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+    'image', 'isindex', 'nextid', 'spacer',
+}
+
+
+class TextExtractor(HTMLParser):
+    """
+    Single-pass HTML-to-text extractor built on the stdlib parser's event API.
+
+    Mirrors BeautifulSoup's get_text(separator=' ', strip=True) with script, style and
+    img removed: each run of text between two markup events is one string, strings are
+    stripped, and empty ones are dropped. Open elements are tracked the way BeautifulSoup
+    builds its tree, so malformed markup skips the same text.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.strings = []
+        self.pending = []
+        self.open_tags = []
+        # Number of SKIPPED_TAGS in open_tags
+        self.skip_depth = 0
+        # Void elements seen as start tags; a later stray end tag for one is ignored entirely
+        self.closed_void_tags = []
+
+    def flush(self):
+        if self.pending:
+            text = ''.join(self.pending).strip()
+            if text:
+                self.strings.append(text)
+            self.pending = []
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        if tag in VOID_TAGS:
+            self.closed_void_tags.append(tag)
+            return
+        self.open_tags.append(tag)
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        # <tag/> opens and closes straight away, so it never contains text
+        self.flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void_tags:
+            self.closed_void_tags.remove(tag)
+            return
+        self.flush()
+        if tag not in self.open_tags:
+            return
+        # Close everything opened since the matching start tag
+        while True:
+            closed = self.open_tags.pop()
+            if closed in SKIPPED_TAGS:
+                self.skip_depth -= 1
+            if closed == tag:
+                return
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.pending.append(data)
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def unknown_decl(self, data):
+        self.flush()
+        if data.startswith('CDATA[') and not self.skip_depth:
+            self.pending.append(data[len('CDATA['):])
+            self.flush()
+
+    def get_text(self):
+        self.close()
+        self.flush()
+        return ' '.join(self.strings)
+
+
+def stdlib_html_to_text(text):
+    extractor = TextExtractor()
+    extractor.feed(text)
+    return extractor.get_text()
+
+def bs4_html_to_text(text):
+    if BeautifulSoup is None:
+        raise ImportError("The 'bs4' HTML backend needs beautifulsoup4 installed")
+
+    soup = BeautifulSoup(text, 'html.parser')
+    for tag in soup.find_all(['img', 'style', 'script']):
+        tag.decompose()
+    return soup.get_text(separator=' ', strip=True)
+
+BACKENDS = {
+    'stdlib': stdlib_html_to_text,
+    'bs4': bs4_html_to_text,
+}
+
+def html_to_text(text, backend='stdlib'):
+    """
+    Extract the visible text from an HTML email body.
+
+    Args:
+        text (str): HTML to extract text from
+        backend (str): Name of the extractor in BACKENDS
+
+    Returns:
+        str: Text content with strings separated by single spaces
+    """
+    return BACKENDS[backend](text)
@@ -0,0 +1,562 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+import openai
+from openai import AsyncOpenAI, OpenAI
+from openai.types import Batch, FileObject
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+import Rate_Limiter
+import Token_Counter
+
+# Model the OpenAI backend embeds with
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Length of the local backend's hash embeddings
+EMBEDDING_DIMENSIONS = 256
+
+# How the local backend behaves under load: seconds before the first token, tokens streamed
+# per second afterwards, and the requests and tokens per minute it accepts per model before
+# answering 429. None means no limit.
+Profile = namedtuple('Profile', ['first_token_latency', 'tokens_per_second', 'requests_per_minute',
+                                 'tokens_per_minute'])
+
+PROFILES = {
+    # No delays or limits, for measuring the pipeline's own overhead
+    'instant': Profile(0.0, None, None, None),
+    # A fast model with headroom to spare
+    'fast': Profile(0.05, 2000, None, None),
+    # Roughly a hosted model at an entry usage tier
+    'realistic': Profile(0.5, 60, 500, 30000),
+    # Limits tight enough that retries and backoff get exercised
+    'throttled': Profile(0.2, 200, 60, 5000),
+}
+
+# Stands in for "no limit" where a rate has to be a number
+UNLIMITED = 10 ** 12
+
+# A local text reply is about this many times shorter than its prompt
+REPLY_RATIO = 4
+
+# Upper bound on a local text reply when the request sets no max_tokens
+REPLY_TOKENS = 500
+
+# Words per streamed chunk from the local backend
+STREAM_CHUNK_WORDS = 4
+
+# Where the local backend keeps the files and batch jobs it emulates. They live on disk so
+# a batch outlives the process that submitted it, like a real one does.
+LOCAL_BATCH_DIR = 'local_batches'
+
+# Status checks a local batch job takes to finish, so callers' polling gets exercised
+LOCAL_BATCH_POLLS = 2
+
+ID_ATTRIBUTE = re.compile(r'\bid="([^"]+)"')
+WORD = re.compile(r'\w+')
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns:
+        The backend every completion and embedding goes through, chosen on first use from
+            the LLM_BACKEND environment variable ('openai', the default, or 'local') and, for
+            the local backend, LLM_BACKEND_PROFILE (a key of PROFILES)
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if os.getenv("LLM_BACKEND", "openai") == "local":
+                _backend = LocalBackend(os.getenv("LLM_BACKEND_PROFILE", "instant"))
+            else:
+                _backend = OpenAIBackend()
+        return _backend
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+class OpenAIBackend:
+    """
+    The OpenAI API. Clients are created without retries, since AI_API retries under its
+    own rate limits.
+    """
+
+    name = 'openai'
+    embedding_model = EMBEDDING_MODEL
+
+    def __init__(self):
+        self._embedding_client = None
+
+    def client(self):
+        return OpenAI(max_retries=0)
+
+    def batch_client(self):
+        # File uploads and batch status checks are not paced by AI_API, so the SDK retries them
+        return OpenAI()
+
+    def rate_limits(self, model):
+        """
+        Returns:
+            None, so AI_API paces requests to the account limits it is configured with
+        """
+        return None
+
+    def async_client(self):
+        return AsyncOpenAI(max_retries=0)
+
+    def embed(self, texts):
+        """
+        Returns:
+            list: An embedding for each text
+        """
+        if self._embedding_client is None:
+            self._embedding_client = OpenAI()
+        response = self._embedding_client.embeddings.create(model=EMBEDDING_MODEL, input=list(texts))
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class SimulatedRateLimitError(openai.RateLimitError):
+    """
+    The local backend's 429. It carries a retry-after header like the real one, so
+    AI_API.retry_delay honours it.
+    """
+
+    def __init__(self, model, retry_after):
+        Exception.__init__(self, f"Simulated rate limit reached for {model}")
+        self.message = str(self)
+        self.request = None
+        self.body = None
+        self.code = "rate_limit_exceeded"
+        self.param = None
+        self.type = "requests"
+        self.status_code = 429
+        self.request_id = None
+        self.response = SimulatedResponse({"retry-after": f"{retry_after:.3f}"})
+
+
+class SimulatedResponse:
+    def __init__(self, headers):
+        self.headers = headers
+        self.status_code = 429
+
+
+class LocalBackend:
+    """
+    Deterministic stand-in for the OpenAI API that never touches the network.
+
+    Replies depend only on the request: text replies are words sampled from the prompt, a
+    fraction of its length, and structured replies follow the request's JSON schema. Arrays
+    of objects with an "id" get one entry per id="..." attribute in the prompt, so batched
+    requests get an answer for every item. Embeddings hash each word of a text into a fixed
+    number of dimensions, so texts that share words land near each other.
+
+    Latency, throughput and per-model rate limits follow a Profile. Requests over a limit
+    fail with SimulatedRateLimitError, the way the real API answers 429.
+
+    The Batch API is emulated too: files.create, files.content and batches.create,
+    retrieve and list. Batch jobs are kept in batch_dir and finish after LOCAL_BATCH_POLLS
+    status checks, outside the rate limits. A request the responder raises on fails on its
+    own and is written to the job's error file.
+
+    Args:
+        profile: A Profile, or the name of one in PROFILES
+        responder (callable): Optional function from a request to its reply text, to
+            replace the built-in replies
+        batch_dir (str): Directory for emulated batch files and jobs
+    """
+
+    name = 'local'
+    # Reported as the model it stands in for, so Telemetry estimates what a real run would cost
+    embedding_model = EMBEDDING_MODEL
+
+    def __init__(self, profile='instant', responder=None, batch_dir=LOCAL_BATCH_DIR):
+        self.profile = PROFILES[profile] if isinstance(profile, str) else profile
+        self.responder = responder or default_reply
+        self.batch_dir = batch_dir
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def client(self):
+        return LocalClient(self)
+
+    def batch_client(self):
+        return LocalClient(self)
+
+    def async_client(self):
+        return AsyncLocalClient(self)
+
+    def rate_limits(self, model):
+        """
+        Returns:
+            tuple: (requests, tokens) per minute the profile allows, for AI_API to pace to
+        """
+        return tuple(UNLIMITED if limit is None else limit
+                     for limit in (self.profile.requests_per_minute, self.profile.tokens_per_minute))
+
+    def admit(self, model, tokens):
+        """
+        Charge a request to the model's simulated limits.
+
+        Raises:
+            SimulatedRateLimitError: If either limit is used up
+        """
+        profile = self.profile
+        if profile.requests_per_minute is None and profile.tokens_per_minute is None:
+            return
+
+        with self.lock:
+            if model not in self.limits:
+                self.limits[model] = [
+                    Rate_Limiter.TokenBucket(limit / 60, limit) if limit is not None else None
+                    for limit in (profile.requests_per_minute, profile.tokens_per_minute)
+                ]
+            requests, token_budget = self.limits[model]
+            wait = max(requests.wait_time(1) if requests else 0.0,
+                       token_budget.wait_time(tokens) if token_budget else 0.0)
+            if wait > 0:
+                raise SimulatedRateLimitError(model, wait)
+            if requests:
+                requests.take(1)
+            if token_budget:
+                token_budget.take(tokens)
+
+    def complete(self, request, limited=True):
+        """
+        Args:
+            request (dict): Chat completion arguments
+            limited (bool): Charge the request to the rate limits, as online requests are
+
+        Returns:
+            tuple: (ChatCompletion, seconds the real API would have taken to return it)
+        """
+        model = request["model"]
+        prompt = "\n".join(message["content"] for message in request["messages"])
+        reply = self.responder(request)
+        prompt_tokens = Token_Counter.count_tokens(prompt, model)
+        completion_tokens = Token_Counter.count_tokens(reply, model)
+        if limited:
+            self.admit(model, prompt_tokens + completion_tokens)
+
+        completion = ChatCompletion.model_validate({
+            'id': 'local-' + request_hash(request)[:24],
+            'object': 'chat.completion',
+            'created': 0,
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': reply},
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        })
+        return completion, self.generation_time(completion_tokens)
+
+    def generation_time(self, tokens):
+        if self.profile.tokens_per_second is None:
+            return self.profile.first_token_latency
+        return self.profile.first_token_latency + tokens / self.profile.tokens_per_second
+
+    def stream(self, completion, include_usage):
+        """
+        Yield a completion as ChatCompletionChunks at the profile's pace.
+        """
+        time.sleep(self.profile.first_token_latency)
+        text = completion.choices[0].message.content
+        pieces = re.findall(r'\S+\s*', text) or [text]
+        for start in range(0, len(pieces), STREAM_CHUNK_WORDS):
+            piece = ''.join(pieces[start:start + STREAM_CHUNK_WORDS])
+            if self.profile.tokens_per_second is not None:
+                time.sleep(Token_Counter.count_tokens(piece, completion.model) / self.profile.tokens_per_second)
+            yield stream_chunk(completion, {'content': piece}, None)
+        yield stream_chunk(completion, {}, 'stop')
+        if include_usage:
+            yield ChatCompletionChunk.model_validate({
+                'id': completion.id, 'object': 'chat.completion.chunk', 'created': completion.created,
+                'model': completion.model, 'choices': [], 'usage': completion.usage.model_dump(),
+            })
+
+    def embed(self, texts):
+        """
+        Returns:
+            list: A hash embedding for each text
+        """
+        time.sleep(self.profile.first_token_latency)
+        return [hash_embedding(text) for text in texts]
+
+    def batch_path(self, name):
+        os.makedirs(self.batch_dir, exist_ok=True)
+        return os.path.join(self.batch_dir, name)
+
+    def save_file(self, data, filename, purpose):
+        """
+        Returns:
+            FileObject: The stored file
+        """
+        file_id = f"file-local-{uuid.uuid4().hex}"
+        with open(self.batch_path(file_id), 'wb') as f:
+            f.write(data)
+        return FileObject.model_validate({
+            'id': file_id, 'object': 'file', 'bytes': len(data), 'created_at': int(time.time()),
+            'filename': filename, 'purpose': purpose, 'status': 'processed',
+        })
+
+    def load_file(self, file_id):
+        with open(self.batch_path(file_id), 'rb') as f:
+            return f.read()
+
+    def load_batch(self, batch_id):
+        """
+        Returns:
+            dict: The stored job: the Batch as a dict, and the status checks it has had
+        """
+        with open(self.batch_path(batch_id + '.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_batch(self, job):
+        path = self.batch_path(job['batch']['id'] + '.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+
+    def run_batch(self, batch):
+        """
+        Answer every request in a batch's input file, and fill in its output and error files.
+        """
+        outputs = []
+        errors = []
+        for line in self.load_file(batch['input_file_id']).decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            try:
+                completion, _ = self.complete(item['body'], limited=False)
+            except Exception as e:
+                errors.append({'id': f"batch_req_{uuid.uuid4().hex}", 'custom_id': item['custom_id'], 'response': None,
+                               'error': {'code': 'local_error', 'message': str(e)}})
+                continue
+            outputs.append({
+                'id': f"batch_req_{uuid.uuid4().hex}", 'custom_id': item['custom_id'], 'error': None,
+                'response': {'status_code': 200, 'request_id': completion.id, 'body': completion.model_dump()},
+            })
+
+        for results, field in ((outputs, 'output_file_id'), (errors, 'error_file_id')):
+            if results:
+                data = "".join(json.dumps(result) + "\n" for result in results).encode('utf-8')
+                batch[field] = self.save_file(data, f"{batch['id']}_{field}.jsonl", 'batch_output').id
+        batch.update(status='completed', completed_at=int(time.time()),
+                     request_counts={'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                     'failed': len(errors)})
+
+
+class LocalChat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class LocalCompletions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, stream=False, stream_options=None, **request):
+        completion, seconds = self.backend.complete(request)
+        if stream:
+            return self.backend.stream(completion, bool((stream_options or {}).get("include_usage")))
+        time.sleep(seconds)
+        return completion
+
+
+class AsyncLocalCompletions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def create(self, **request):
+        completion, seconds = self.backend.complete(request)
+        await asyncio.sleep(seconds)
+        return completion
+
+
+class LocalFiles:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, file, purpose):
+        data = file.read() if hasattr(file, 'read') else file
+        return self.backend.save_file(data, os.path.basename(getattr(file, 'name', 'upload.jsonl')), purpose)
+
+    def content(self, file_id):
+        return LocalFileContent(self.backend.load_file(file_id))
+
+
+class LocalFileContent:
+    def __init__(self, content):
+        self.content = content
+        self.text = content.decode('utf-8')
+
+
+class LocalBatches:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch = {
+            'id': f"batch_local_{uuid.uuid4().hex}", 'object': 'batch', 'endpoint': endpoint,
+            'input_file_id': input_file_id, 'completion_window': completion_window,
+            'status': 'validating', 'created_at': int(time.time()), 'metadata': metadata,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+        }
+        with self.backend.lock:
+            self.backend.save_batch({'batch': batch, 'polls': 0})
+        return Batch.model_validate(batch)
+
+    def retrieve(self, batch_id):
+        with self.backend.lock:
+            job = self.backend.load_batch(batch_id)
+            batch = job['batch']
+            if batch['status'] in ('validating', 'in_progress'):
+                job['polls'] += 1
+                if job['polls'] >= LOCAL_BATCH_POLLS:
+                    self.backend.run_batch(batch)
+                else:
+                    batch['status'] = 'in_progress'
+                self.backend.save_batch(job)
+        return Batch.model_validate(batch)
+
+    def list(self, limit=20):
+        """
+        Returns:
+            LocalPage: The most recent batches, newest first
+        """
+        with self.backend.lock:
+            names = os.listdir(self.backend.batch_dir) if os.path.isdir(self.backend.batch_dir) else []
+            batches = [self.backend.load_batch(name[:-len('.json')])['batch']
+                       for name in names if name.startswith('batch_local_') and name.endswith('.json')]
+        batches.sort(key=lambda batch: batch['created_at'], reverse=True)
+        return LocalPage([Batch.model_validate(batch) for batch in batches[:limit]])
+
+
+class LocalPage:
+    def __init__(self, data):
+        self.data = data
+
+
+class LocalClient:
+    """
+    Stands in for an OpenAI client: chat.completions.create, streaming included, and the
+    files and batches endpoints of the Batch API.
+    """
+
+    def __init__(self, backend):
+        self.chat = LocalChat(LocalCompletions(backend))
+        self.files = LocalFiles(backend)
+        self.batches = LocalBatches(backend)
+
+
+class AsyncLocalClient:
+    """
+    Stands in for an AsyncOpenAI client, including its use as an async context manager.
+    """
+
+    def __init__(self, backend):
+        self.chat = LocalChat(AsyncLocalCompletions(backend))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        pass
+
+
+def request_hash(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def default_reply(request):
+    """
+    Returns:
+        str: The local backend's reply to a request, the same every time it is asked
+    """
+    rng = random.Random(request_hash(request))
+    prompt = "\n".join(message["content"] for message in request["messages"])
+
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        return json.dumps(schema_instance(schema, ID_ATTRIBUTE.findall(prompt), rng))
+    if response_format.get("type") == "json_object":
+        return "{}"
+
+    # Words from the prompt, in order, about REPLY_RATIO times fewer of them
+    words = prompt.split()
+    count = min(request.get("max_tokens") or REPLY_TOKENS, max(1, len(words) // REPLY_RATIO), len(words))
+    return " ".join(words[i] for i in sorted(rng.sample(range(len(words)), count)))
+
+def schema_instance(schema, ids, rng, item_id=None):
+    """
+    Returns:
+        A value matching a JSON schema. Arrays of objects with an "id" property get one item
+            per id in ids, and other arrays one item.
+    """
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    kind = schema.get("type")
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return {
+            name: item_id if name == "id" and item_id is not None else schema_instance(value, ids, rng)
+            for name, value in properties.items()
+        }
+    if kind == "array":
+        items = schema.get("items", {})
+        if items.get("type") == "object" and "id" in items.get("properties", {}) and ids:
+            return [schema_instance(items, ids, rng, item_id=i) for i in ids]
+        return [schema_instance(items, ids, rng)]
+    if kind == "string":
+        return f"local {rng.getrandbits(32):08x}"
+    if kind == "integer":
+        return 0
+    if kind == "number":
+        return 0.0
+    if kind == "boolean":
+        return False
+    return None
+
+def stream_chunk(completion, delta, finish_reason):
+    return ChatCompletionChunk.model_validate({
+        'id': completion.id,
+        'object': 'chat.completion.chunk',
+        'created': completion.created,
+        'model': completion.model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    })
+
+def hash_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    """
+    Returns:
+        list: A unit vector in which each word of text adds +1 or -1 to a dimension picked by
+            its hash
+    """
+    vector = [0.0] * dimensions
+    for word in WORD.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], 'big') % dimensions] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from openai.types.chat import ChatCompletion
+
+# Default location of the on-disk completion cache
+CACHE_PATH = 'llm_cache.db'
+
+# Least recently used completions are evicted past either limit
+MAX_ENTRIES = 20000
+MAX_BYTES = 64 * 1024 * 1024
+
+# Completions older than this are never served
+TTL_SECONDS = 30 * 24 * 60 * 60
+
+
+def cache_key(request, prompt_version):
+    """
+    Hash a chat completion request into a cache key.
+
+    The key covers every request argument (model, temperature, messages and the rest) plus
+    the caller's prompt template version, so bumping the version retires old outputs.
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    payload = json.dumps({'prompt_version': prompt_version, 'request': request},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """
+    Disk-backed, content-addressed cache of chat completions.
+
+    Entries expire after `ttl` seconds, and the least recently used ones are evicted once
+    the cache holds more than `max_entries` completions or `max_bytes` of them.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, ttl=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    completion TEXT,
+                    size INTEGER,
+                    created REAL,
+                    last_used REAL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key):
+        """
+        Returns:
+            ChatCompletion: The cached completion for key, or None if there is no live entry
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT completion, created FROM completions WHERE key = ?',
+                                    (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            with self.conn:
+                self.conn.execute('UPDATE completions SET last_used = ? WHERE key = ?', (now, key))
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key, completion):
+        data = completion.model_dump_json()
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO completions (key, model, completion, size, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, completion.model, data, len(data), now, now)
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        self.conn.execute('DELETE FROM completions WHERE created < ?', (now - self.ttl,))
+
+        count, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+
+        # Walk from least to most recently used until both limits are met
+        evicted = []
+        for key, entry_size in self.conn.execute('SELECT key, size FROM completions ORDER BY last_used'):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            count -= 1
+            size -= entry_size
+        self.conn.executemany('DELETE FROM completions WHERE key = ?', evicted)
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, hit_rate, and the number and total size of cached completions
+        """
+        with self.lock:
+            entries, size = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+                'bytes': size,
+            }
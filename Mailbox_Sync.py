@@ -0,0 +1,119 @@
+import Gmail_Interface
+import VectorDB
+from googleapiclient.errors import HttpError
+
+
+class MailboxSync:
+    """
+    Keeps the unread inbox (Email objects and the vector collection) in step with Gmail.
+
+    The first sync lists everything. Later refreshes replay the mailbox history since the
+    saved history ID, so they only download and embed what changed. Emails are tracked
+    header-first: bodies are downloaded, and emails embedded, only once a command needs them.
+    """
+
+    def __init__(self, service, collection, store=None):
+        self.service = service
+        self.collection = collection
+        # Optional Message_Store.MessageStore, so known messages are never downloaded twice
+        self.store = store
+        self.history_id = None
+        # Gmail message ID -> Email object, for every unread inbox message
+        self.emails = {}
+        # Message IDs tracked but not yet embedded in the vector collection
+        self.unindexed = set()
+
+    def email_objects(self):
+        """
+        Returns:
+            list: Email objects for every unread inbox message currently tracked
+        """
+        return list(self.emails.values())
+
+    def full_sync(self):
+        """
+        Drop everything tracked so far and relist the whole unread inbox from Gmail.
+        """
+        # Read the history ID before listing so anything that changes mid-listing is replayed next time
+        history_id = Gmail_Interface.get_current_history_id(self.service)
+
+        VectorDB.remove_emails_from_vectorDB(
+            self.collection, [msg_id for msg_id in self.emails if msg_id not in self.unindexed]
+        )
+        self.emails = {}
+        self.unindexed = set()
+        self._track(Gmail_Interface.iter_unread_email_objects(
+            self.service, store=self.store, headers_only=True
+        ))
+
+        self.history_id = history_id
+
+    def refresh(self):
+        """
+        Apply the changes since the last sync, falling back to a full resync if Gmail
+        no longer has history for the saved history ID.
+
+        Returns:
+            tuple: (number of emails added, number of emails removed)
+        """
+        if self.history_id is None:
+            self.full_sync()
+            return len(self.emails), 0
+
+        try:
+            changes, history_id = Gmail_Interface.get_history_changes(self.service, self.history_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("Saved history ID has expired, running a full resync...")
+            self.full_sync()
+            return len(self.emails), 0
+
+        added_ids = [msg_id for msg_id, in_inbox in changes.items() if in_inbox and msg_id not in self.emails]
+        removed_ids = [msg_id for msg_id, in_inbox in changes.items() if not in_inbox and msg_id in self.emails]
+
+        VectorDB.remove_emails_from_vectorDB(
+            self.collection, [msg_id for msg_id in removed_ids if msg_id not in self.unindexed]
+        )
+        for msg_id in removed_ids:
+            del self.emails[msg_id]
+            self.unindexed.discard(msg_id)
+
+        added = self._track(Gmail_Interface.iter_email_objects_for_ids(
+            self.service, added_ids, self.store, headers_only=True
+        ))
+
+        self.history_id = history_id
+        return added, len(removed_ids)
+
+    def load_bodies(self):
+        """
+        Download the body of every tracked email that so far only has its headers.
+        """
+        Gmail_Interface.hydrate_email_bodies(self.service, self.emails.values(), self.store)
+
+    def ensure_indexed(self):
+        """
+        Embed every tracked email that isn't in the vector collection yet, loading bodies first.
+        """
+        if not self.unindexed:
+            return
+
+        pending = [self.emails[msg_id] for msg_id in self.emails if msg_id in self.unindexed]
+        Gmail_Interface.hydrate_email_bodies(self.service, pending, self.store)
+        VectorDB.add_emails_to_vectorDB(self.collection, pending)
+        self.unindexed = set()
+
+    def _track(self, email_objects):
+        """
+        Record a stream of Email objects as tracked and waiting to be embedded.
+
+        Returns:
+            int: Number of emails added
+        """
+        count = 0
+        for email in email_objects:
+            self.emails[email.message_id] = email
+            self.unindexed.add(email.message_id)
+            count += 1
+        return count
@@ -0,0 +1,178 @@
+import json
+import sqlite3
+import zlib
+import Email_Extractor
+import Gmail_Interface
+
+# Default location of the on-disk message cache
+STORE_PATH = 'message_store.db'
+
+# SQLite caps the number of bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+
+class MessageStore:
+    """
+    On-disk cache of Gmail messages keyed by message ID.
+
+    Each row holds the compressed raw payload plus the parsed fields needed to rebuild an
+    Email object, so a warm start never re-downloads or re-cleans a message it has seen.
+    Rows written by an older PARSE_VERSION are re-parsed from the stored payload locally.
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    history_id TEXT,
+                    thread_id TEXT,
+                    internal_date INTEGER,
+                    label_ids TEXT,
+                    sender TEXT,
+                    subject TEXT,
+                    text TEXT,
+                    token_count INTEGER,
+                    parse_version INTEGER,
+                    raw BLOB
+                )
+            ''')
+            # Stores created before label_ids existed get the column added in place
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(messages)')}
+            if 'label_ids' not in columns:
+                self.conn.execute('ALTER TABLE messages ADD COLUMN label_ids TEXT')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS messages_history_id ON messages (history_id)')
+            # Structured extractions (Email_Extractor), tagged with the prompt and model that made them
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS extractions (
+                    message_id TEXT PRIMARY KEY,
+                    version TEXT,
+                    data TEXT
+                )
+            ''')
+
+    def close(self):
+        self.conn.close()
+
+    def get_emails(self, msg_ids):
+        """
+        Load Email objects for the given message IDs.
+
+        Args:
+            msg_ids (list): Gmail message IDs to look up
+
+        Returns:
+            dict: Message ID -> Email object, for every ID found in the store
+        """
+        emails = {}
+        stale = []
+
+        for start in range(0, len(msg_ids), MAX_QUERY_PARAMS):
+            chunk = msg_ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f'SELECT message_id, thread_id, internal_date, label_ids, sender, subject, text, '
+                f'token_count, parse_version, raw FROM messages WHERE message_id IN ({placeholders})',
+                chunk
+            ).fetchall()
+
+            for (message_id, thread_id, internal_date, label_ids, sender, subject, text,
+                 token_count, parse_version, raw) in rows:
+                if parse_version != Gmail_Interface.PARSE_VERSION:
+                    stale.append(decompress_message(raw))
+                    continue
+                emails[message_id] = Gmail_Interface.Email(
+                    sender=sender,
+                    subject=subject,
+                    text=text,
+                    token_count=token_count,
+                    message_id=message_id,
+                    thread_id=thread_id,
+                    internal_date=internal_date,
+                    label_ids=label_ids.split(',') if label_ids else ()
+                )
+
+        # Parsing rules changed since these were cached, so rebuild them from the stored payload
+        if stale:
+            reparsed = list(Gmail_Interface.iter_parsed_emails(stale))
+            self.save_messages(reparsed)
+            emails.update((email.message_id, email) for _, email in reparsed)
+
+        return emails
+
+    def save_messages(self, messages_and_emails):
+        """
+        Store raw Gmail messages along with the Email objects parsed from them.
+
+        Args:
+            messages_and_emails: Iterable of (Gmail message dict, Email object) pairs
+        """
+        rows = [
+            (
+                message['id'],
+                message.get('historyId'),
+                message.get('threadId'),
+                int(message.get('internalDate', 0)),
+                ','.join(message.get('labelIds', [])),
+                email.sender,
+                email.subject,
+                email.text,
+                email.token_count,
+                Gmail_Interface.PARSE_VERSION,
+                compress_message(message)
+            )
+            for message, email in messages_and_emails
+        ]
+        if not rows:
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO messages (message_id, history_id, thread_id, internal_date, '
+                'label_ids, sender, subject, text, token_count, parse_version, raw) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def get_extractions(self, msg_ids, version):
+        """
+        Load stored extractions made with the given Email_Extractor.extraction_version().
+
+        Returns:
+            dict: Message ID -> Email_Extractor.Extraction, for every ID found
+        """
+        extractions = {}
+        for start in range(0, len(msg_ids), MAX_QUERY_PARAMS):
+            chunk = msg_ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            for message_id, data in self.conn.execute(
+                f'SELECT message_id, data FROM extractions WHERE version = ? AND message_id IN ({placeholders})',
+                [version, *chunk]
+            ):
+                extraction = Email_Extractor.from_json(data)
+                if extraction is not None:
+                    extractions[message_id] = extraction
+        return extractions
+
+    def save_extractions(self, extractions, version):
+        """
+        Args:
+            extractions: Iterable of (message ID, Email_Extractor.Extraction) pairs
+            version (str): Email_Extractor.extraction_version() they were made with
+        """
+        rows = [(message_id, version, Email_Extractor.to_json(extraction))
+                for message_id, extraction in extractions]
+        if not rows:
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO extractions (message_id, version, data) VALUES (?, ?, ?)', rows)
+
+
+def compress_message(message):
+    return zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+def decompress_message(raw):
+    return json.loads(zlib.decompress(raw).decode('utf-8'))
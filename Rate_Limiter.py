@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+# Defaults for exponential backoff between retries, in seconds
+BASE_DELAY = 1
+MAX_DELAY = 32
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that refills at `rate` tokens per second up to `capacity`.
+
+    acquire() may take more tokens than are available: the bucket goes into debt and the
+    caller sleeps until it is paid back, so callers are served roughly in arrival order
+    and requests larger than the capacity still go through.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """
+        Take `amount` tokens, sleeping until the bucket can cover them.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def wait_time(self, amount):
+        """
+        Returns:
+            float: Seconds until the bucket holds `amount` tokens, or is full if `amount` is
+                more than it can hold
+        """
+        with self.lock:
+            self._refill()
+            return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, amount):
+        """
+        Take `amount` tokens without waiting, going into debt if needed. A negative amount
+        gives tokens back, up to the capacity.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class PriorityRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets shared by many callers.
+
+    Callers are admitted one at a time in priority order (lower numbers first), then in
+    arrival order, once both budgets can cover them; a higher-priority caller that arrives
+    later still goes ahead of everyone waiting. Token costs are estimates when a caller is
+    admitted, and settle() corrects the budget once the real usage is known.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.arrivals = itertools.count()
+
+    def acquire(self, tokens, priority=0):
+        """
+        Wait until this caller is first in line and both budgets cover one request of
+        `tokens` tokens, then take them.
+        """
+        ticket = (priority, next(self.arrivals))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            # Whoever is first in line may have just lost its place
+            self.condition.notify_all()
+            while True:
+                if self.waiting[0] == ticket:
+                    wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        heapq.heappop(self.waiting)
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def settle(self, estimated, actual):
+        """
+        Correct the token budget once a request's real usage is known.
+        """
+        self.tokens.take(actual - estimated)
+        with self.condition:
+            self.condition.notify_all()
+
+
+def backoff_delay(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """
+    Exponential backoff with full jitter: a random delay up to base_delay * 2^attempt.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def retry_with_backoff(fn, is_retryable, max_retries=5, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """
+    Call fn(), retrying with jittered exponential backoff while it raises retryable errors.
+
+    Args:
+        fn: Zero-argument callable to run
+        is_retryable: Called with the raised exception; return True to retry it
+        max_retries (int): Retries allowed after the first attempt
+        base_delay (float): Delay scale for the first retry, in seconds
+        max_delay (float): Upper bound for any single delay, in seconds
+
+    Returns:
+        Whatever fn() returns. The last error is re-raised once retries are exhausted.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
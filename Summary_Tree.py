@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import sqlite3
+import time
+from collections import namedtuple
+import AI_API
+import LLM_Backend
+import Token_Counter
+
+# Default location of the on-disk summary tree
+TREE_PATH = 'summary_tree.db'
+
+# A group of children is closed after any child whose hash is a multiple of FANOUT, so
+# groups hold about FANOUT children and their boundaries only depend on nearby content
+FANOUT = 8
+
+# Same limit as the depth guard in AI_API.summarize_array
+MAX_DEPTH = 5
+
+# SQLite caps the number of bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+# Stored summaries not used by any build for this long are deleted
+NODE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# One entry on a level of the tree: an email, or the summary of a group of entries below it
+Node = namedtuple('Node', ['hash', 'text', 'token_count'])
+
+
+def content_hash(kind, parts, stage):
+    """
+    Returns:
+        str: Hex digest of the parts, the model for the stage and the prompt version
+    """
+    digest = hashlib.sha256()
+    for part in (kind, AI_API.model_for(stage), str(AI_API.PROMPT_VERSION), *parts):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def is_group_boundary(node_hash, depth):
+    """
+    Boundaries are drawn afresh on every level, so a child carried up unchanged does not
+    split the level above at the same place again.
+    """
+    digest = hashlib.sha256(f'{depth}:{node_hash}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % FANOUT == 0
+
+
+class SummaryTree:
+    """
+    Persistent hierarchical summary whose nodes are addressed by content.
+
+    Leaves are email texts keyed by the hash of their content, and each internal node is
+    the summary of a group of children keyed by the hash of the children's hashes. Groups
+    end at content-defined boundaries (or when the token budget is full), so adding or
+    removing an email changes only its own group and the nodes on the path above it. Every
+    other node is found in the store and costs no API call.
+    """
+
+    def __init__(self, path=TREE_PATH):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS nodes (
+                    hash TEXT PRIMARY KEY,
+                    summary TEXT,
+                    token_count INTEGER,
+                    last_used REAL
+                )
+            ''')
+        # Number of nodes the last build could not find in the store and had to summarize
+        self.computed = 0
+
+    def close(self):
+        self.conn.close()
+
+    def summarize(self, texts, token_counts=None):
+        """
+        Summarize texts into a single string, reusing every unchanged part of the tree.
+
+        Args:
+            texts (list): Texts to summarize, oldest first so new ones extend the tree
+            token_counts (list): Token count of each text, if already known
+
+        Returns:
+            str: Single summarized string
+        """
+        return self.reduce(texts, token_counts, summarize_root=True).text
+
+    def stream(self, texts, token_counts=None):
+        """
+        Streaming version of summarize: the tree below the root is brought up to date first,
+        then the root summary streams unless it is already stored.
+
+        Returns:
+            AI_API.CompletionStream: The root summary, piece by piece
+        """
+        root = self.reduce(texts, token_counts, summarize_root=False)
+        if root.token_count is not None:
+            return AI_API.CompletionStream(text=root.text)
+
+        def save_root(summary):
+            self.save([Node(root.hash, summary, AI_API.num_tokens_from_string(summary))])
+
+        self.computed += 1
+        return AI_API.stream_summarize_text(root.text, on_complete=save_root, stage="reduce")
+
+    def reduce(self, texts, token_counts, summarize_root):
+        """
+        Bring every node of the tree up to date.
+
+        Returns:
+            Node: The root. Unless summarize_root is set, a root not already stored is
+                returned unsummarized, with the joined text of its children and no token count.
+        """
+        self.computed = 0
+        if not texts:
+            return Node(None, "", 0)
+        if token_counts is None:
+            token_counts = Token_Counter.count_many(texts)
+
+        async def run():
+            async with LLM_Backend.get_backend().async_client() as async_client:
+                return await self.build(AI_API.AsyncSummarizer(async_client), texts, token_counts,
+                                        summarize_root)
+
+        root = asyncio.run(run())
+        self.prune()
+        return root
+
+    async def build(self, summarizer, texts, token_counts, summarize_root):
+        separator_tokens = AI_API.num_tokens_from_string(AI_API.EMAIL_SEPARATOR) + 1
+        final_budget = AI_API.summary_input_budget("reduce")
+
+        level = await self.leaves(summarizer, texts, token_counts)
+        for depth in range(MAX_DEPTH + 1):
+            # A level that fits in a single call to the reduce model is the root's children
+            if sum(node.token_count + separator_tokens for node in level) <= final_budget + separator_tokens:
+                return await self.root(summarizer, level, summarize_root)
+
+            # Emails are grouped and summarized on the leaf model, summaries on the reduce model
+            stage = "leaf_summary" if depth == 0 else "reduce"
+            groups = self.group(level, AI_API.summary_input_budget(stage), separator_tokens, depth)
+            level = await self.summarize_groups(summarizer, groups, stage, final_budget)
+
+        return Node(None, "Summary truncated due to recursion limit.", 0)
+
+    async def root(self, summarizer, children, summarize_root):
+        """
+        Returns:
+            Node: The root over children, summarized if stored or if summarize_root is set
+        """
+        root = self.group_node(children, "reduce")
+        stored = self.load([root.hash])
+        if root.hash in stored or not summarize_root:
+            return stored.get(root.hash, root)
+
+        errors = summarizer.errors
+        summary = await summarizer.summarize_text(root.text, "reduce")
+        self.computed += 1
+        node = Node(root.hash, summary, AI_API.num_tokens_from_string(summary))
+        self.save_if_clean([node], summarizer, errors)
+        return node
+
+    async def leaves(self, summarizer, texts, token_counts):
+        """
+        Returns:
+            list: A Node per text. Texts too long for one leaf summary call are replaced by
+                the summary of their chunks, which is stored like any other node.
+        """
+        budget = AI_API.summary_input_budget("leaf_summary")
+        nodes = [Node(content_hash('leaf', [text], "leaf_summary"), text, token_count)
+                 for text, token_count in zip(texts, token_counts)]
+        oversized = [i for i, node in enumerate(nodes) if node.token_count > budget]
+        stored = self.load([nodes[i].hash for i in oversized])
+
+        missing = [i for i in oversized if nodes[i].hash not in stored]
+        errors = summarizer.errors
+        summaries = await asyncio.gather(*(
+            summarizer.summarize_array(AI_API.split_text_into_chunks(texts[i], budget), 1,
+                                       stage="leaf_summary")
+            for i in missing
+        ))
+        self.computed += len(missing)
+        new_nodes = [Node(nodes[i].hash, summary, AI_API.num_tokens_from_string(summary))
+                     for i, summary in zip(missing, summaries)]
+        self.save_if_clean(new_nodes, summarizer, errors)
+        stored.update((node.hash, node) for node in new_nodes)
+
+        return [stored.get(node.hash, node) for node in nodes]
+
+    @staticmethod
+    def group(level, budget, separator_tokens, depth):
+        """
+        Split a level into groups that each fit in one summary call.
+
+        Returns:
+            list: Lists of consecutive Nodes
+        """
+        groups = []
+        used = 0
+        closed = True
+        for node in level:
+            cost = node.token_count + separator_tokens
+            if closed or used + cost > budget + separator_tokens:
+                groups.append([])
+                used = 0
+            groups[-1].append(node)
+            used += cost
+            closed = is_group_boundary(node.hash, depth)
+        return groups
+
+    async def summarize_groups(self, summarizer, groups, stage, carry_limit):
+        """
+        Returns:
+            list: The Node for each group, summarizing only the groups not already stored
+        """
+        # A lone child is carried up unchanged if the reduce model can take it as it is
+        nodes = [
+            group[0] if len(group) == 1 and group[0].token_count <= carry_limit
+            else self.group_node(group, stage)
+            for group in groups
+        ]
+        pending = [i for i, node in enumerate(nodes) if node.token_count is None]
+        stored = self.load([nodes[i].hash for i in pending])
+
+        missing = [i for i in pending if nodes[i].hash not in stored]
+        errors = summarizer.errors
+        summaries = await asyncio.gather(*(summarizer.summarize_text(nodes[i].text, stage) for i in missing))
+        self.computed += len(missing)
+        counts = Token_Counter.count_many(list(summaries))
+        new_nodes = [Node(nodes[i].hash, summary, count)
+                     for i, summary, count in zip(missing, summaries, counts)]
+        self.save_if_clean(new_nodes, summarizer, errors)
+        stored.update((node.hash, node) for node in new_nodes)
+
+        return [stored.get(node.hash, node) for node in nodes]
+
+    @staticmethod
+    def group_node(group, stage):
+        """
+        Returns:
+            Node: The unsummarized node for a group, holding its children's joined text
+        """
+        return Node(content_hash('node', [child.hash for child in group], stage),
+                    AI_API.EMAIL_SEPARATOR.join(child.text for child in group), None)
+
+    def load(self, hashes):
+        """
+        Returns:
+            dict: Hash -> stored Node, for every hash found. Found nodes are marked as used.
+        """
+        stored = {}
+        for start in range(0, len(hashes), MAX_QUERY_PARAMS):
+            chunk = hashes[start:start + MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            for node_hash, summary, token_count in self.conn.execute(
+                f'SELECT hash, summary, token_count FROM nodes WHERE hash IN ({placeholders})', chunk
+            ):
+                stored[node_hash] = Node(node_hash, summary, token_count)
+
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('UPDATE nodes SET last_used = ? WHERE hash = ?',
+                                  [(now, node_hash) for node_hash in stored])
+        return stored
+
+    def save(self, nodes):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO nodes (hash, summary, token_count, last_used) VALUES (?, ?, ?, ?)',
+                [(node.hash, node.text, node.token_count, now) for node in nodes]
+            )
+
+    def save_if_clean(self, nodes, summarizer, errors_before):
+        """
+        Save nodes unless a summary call failed while they were made, so a fallback never
+        becomes part of the tree. The calls that did succeed are in the completion cache,
+        so building these nodes again next time is free.
+        """
+        if summarizer.errors == errors_before:
+            self.save(nodes)
+
+    def prune(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM nodes WHERE last_used < ?', (time.time() - NODE_TTL_SECONDS,))
@@ -0,0 +1,292 @@
+import bisect
+import json
+import threading
+import time
+from collections import deque
+
+# Dollars per million tokens (input, output), longest prefix match wins. Estimates only:
+# check current pricing before relying on the totals.
+PRICES = {
+    "gpt-4": (30.00, 60.00),
+    "gpt-4-32k": (60.00, 120.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+# Batch API requests are billed at this fraction of the normal price
+BATCH_DISCOUNT = 0.5
+
+# Upper bounds, in seconds, of the latency histogram buckets, which the reported
+# percentiles are also estimated from
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 7.5, 10, 15, 30, 60, float('inf'))
+
+# Events kept in memory for export; the totals and histograms cover every event
+MAX_EVENTS = 100000
+
+# Prefix of every exported Prometheus metric
+METRIC_PREFIX = "gmail_reader_llm"
+
+# Where the UX exports the current session
+EVENTS_PATH = 'llm_events.jsonl'
+METRICS_PATH = 'llm_metrics.prom'
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, batch=False):
+    """
+    Returns:
+        float: Estimated dollars for a call, or 0.0 for a model with no known price
+    """
+    matches = [name for name in PRICES if model and model.startswith(name)]
+    if not matches:
+        return 0.0
+    input_price, output_price = PRICES[max(matches, key=len)]
+    cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    return cost * BATCH_DISCOUNT if batch else cost
+
+
+class Telemetry:
+    """
+    Records a structured event for every LLM and embedding call and aggregates them per
+    (kind, stage, model): call counts by status, tokens, estimated cost and a latency
+    histogram.
+
+    Each attempt at a call is its own event. status is 'ok', 'retry' (failed, then tried
+    again), 'error' (failed for good) or 'cached' (answered by the completion cache).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.events = deque(maxlen=MAX_EVENTS)
+        # (kind, stage, model) -> totals for that series
+        self.series = {}
+
+    def record(self, kind, stage, model, status, latency=None, prompt_tokens=0, completion_tokens=0,
+               first_token_latency=None, wait=0.0, error=None, batch=False):
+        """
+        Record one call.
+
+        Args:
+            kind (str): 'chat', 'embedding' or 'batch'
+            stage (str): Pipeline stage that made the call
+            model (str): Model called
+            status (str): 'ok', 'retry', 'error' or 'cached'
+            latency (float): Seconds the call took, not counting time waiting on rate limits,
+                or None if not measured (cache hits, batch requests)
+            prompt_tokens (int): Input tokens
+            completion_tokens (int): Output tokens
+            first_token_latency (float): Seconds to the first streamed token, for streams
+            wait (float): Seconds spent waiting on the client-side rate limits
+            error (str): Name of the error, for failed attempts
+            batch (bool): Billed at the Batch API price
+        """
+        cost = estimate_cost(model, prompt_tokens, completion_tokens, batch) if status == 'ok' else 0.0
+        event = {
+            'time': time.time(),
+            'kind': kind,
+            'stage': stage or 'unknown',
+            'model': model,
+            'status': status,
+            'latency': latency,
+            'wait': wait,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': cost,
+        }
+        if first_token_latency is not None:
+            event['first_token_latency'] = first_token_latency
+        if error is not None:
+            event['error'] = error
+
+        with self.lock:
+            self.events.append(event)
+            key = (kind, event['stage'], model)
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {
+                    'statuses': {}, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'wait': 0.0,
+                    'latency_buckets': [0] * len(LATENCY_BUCKETS), 'latency_sum': 0.0,
+                }
+            series['statuses'][status] = series['statuses'].get(status, 0) + 1
+            series['prompt_tokens'] += prompt_tokens
+            series['completion_tokens'] += completion_tokens
+            series['cost'] += cost
+            series['wait'] += wait
+            if latency is not None:
+                series['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+                series['latency_sum'] += latency
+        return event
+
+    def summary(self):
+        """
+        Returns:
+            list: A dict per (kind, stage, model) with call counts, retries, errors, cache hits,
+                tokens, cost, time waiting on rate limits and latency percentiles, estimated
+                from the histogram
+        """
+        with self.lock:
+            rows = []
+            for (kind, stage, model), series in sorted(self.series.items()):
+                statuses = series['statuses']
+                buckets = series['latency_buckets']
+                rows.append({
+                    'kind': kind,
+                    'stage': stage,
+                    'model': model,
+                    'calls': statuses.get('ok', 0) + statuses.get('error', 0),
+                    'cached': statuses.get('cached', 0),
+                    'retries': statuses.get('retry', 0),
+                    'errors': statuses.get('error', 0),
+                    'prompt_tokens': series['prompt_tokens'],
+                    'completion_tokens': series['completion_tokens'],
+                    'cost': series['cost'],
+                    'wait': series['wait'],
+                    'latency_p50': percentile(buckets, 0.5),
+                    'latency_p95': percentile(buckets, 0.95),
+                })
+            return rows
+
+    def totals(self):
+        """
+        Returns:
+            dict: The summary rows added together
+        """
+        totals = {'calls': 0, 'cached': 0, 'retries': 0, 'errors': 0, 'prompt_tokens': 0,
+                  'completion_tokens': 0, 'cost': 0.0, 'wait': 0.0}
+        for row in self.summary():
+            for name in totals:
+                totals[name] += row[name]
+        return totals
+
+    def report(self):
+        """
+        Returns:
+            str: The summary as a table, one line per stage and model
+        """
+        lines = [f"{'stage':<20} {'model':<22} {'calls':>6} {'cached':>6} {'retry':>5} {'err':>4} "
+                 f"{'prompt':>9} {'output':>8} {'cost $':>9} {'p50 s':>7} {'p95 s':>7}"]
+        for row in self.summary():
+            stage = row['stage'] if row['kind'] == 'chat' else f"{row['stage']} ({row['kind']})"
+            lines.append(
+                f"{stage:<20} {row['model']:<22} {row['calls']:>6} {row['cached']:>6} {row['retries']:>5} "
+                f"{row['errors']:>4} {row['prompt_tokens']:>9} {row['completion_tokens']:>8} "
+                f"{row['cost']:>9.4f} {row['latency_p50']:>7.2f} {row['latency_p95']:>7.2f}"
+            )
+        totals = self.totals()
+        lines.append(
+            f"{'total':<43} {totals['calls']:>6} {totals['cached']:>6} {totals['retries']:>5} "
+            f"{totals['errors']:>4} {totals['prompt_tokens']:>9} {totals['completion_tokens']:>8} "
+            f"{totals['cost']:>9.4f}"
+        )
+        lines.append(f"Waiting on rate limits: {totals['wait']:.1f}s over {time.time() - self.started:.0f}s")
+        return "\n".join(lines)
+
+    def write_jsonl(self, path=EVENTS_PATH):
+        """
+        Write every event kept in memory to path, one JSON object per line.
+        """
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event))
+                f.write("\n")
+
+    def prometheus(self):
+        """
+        Returns:
+            str: The totals and latency histograms in the Prometheus text exposition format
+        """
+        lines = []
+
+        def header(name, kind, description):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+
+        with self.lock:
+            series = sorted(self.series.items())
+
+            header("calls_total", "counter", "LLM and embedding call attempts by status")
+            for key, totals in series:
+                for status, count in sorted(totals['statuses'].items()):
+                    lines.append(f"{METRIC_PREFIX}_calls_total{labels(key, status=status)} {count}")
+
+            header("tokens_total", "counter", "Tokens sent and received")
+            for key, totals in series:
+                lines.append(f"{METRIC_PREFIX}_tokens_total{labels(key, type='prompt')} {totals['prompt_tokens']}")
+                lines.append(f"{METRIC_PREFIX}_tokens_total{labels(key, type='completion')} {totals['completion_tokens']}")
+
+            header("cost_dollars_total", "counter", "Estimated cost in US dollars")
+            for key, totals in series:
+                lines.append(f"{METRIC_PREFIX}_cost_dollars_total{labels(key)} {totals['cost']:.6f}")
+
+            header("rate_limit_wait_seconds_total", "counter", "Time spent waiting on client-side rate limits")
+            for key, totals in series:
+                lines.append(f"{METRIC_PREFIX}_rate_limit_wait_seconds_total{labels(key)} {totals['wait']:.6f}")
+
+            header("latency_seconds", "histogram", "Call latency, not counting rate limit waits, cache hits or batch requests")
+            for key, totals in series:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, totals['latency_buckets']):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{METRIC_PREFIX}_latency_seconds_bucket{labels(key, le=le)} {cumulative}")
+                lines.append(f"{METRIC_PREFIX}_latency_seconds_sum{labels(key)} {totals['latency_sum']:.6f}")
+                lines.append(f"{METRIC_PREFIX}_latency_seconds_count{labels(key)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=METRICS_PATH):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+
+
+def percentile(buckets, fraction):
+    """
+    Estimate a percentile from histogram bucket counts the way Prometheus's
+    histogram_quantile does, interpolating linearly inside the bucket it falls in.
+
+    Returns:
+        float: The estimate in seconds, or 0.0 for an empty histogram
+    """
+    rank = fraction * sum(buckets)
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(LATENCY_BUCKETS, buckets):
+        if count and cumulative + count >= rank:
+            # Nothing is known above the last finite bound
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return 0.0
+
+def labels(key, **extra):
+    kind, stage, model = key
+    pairs = [('kind', kind), ('stage', stage), ('model', model), *extra.items()]
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+# Shared recorder for the whole session
+telemetry = Telemetry()
+
+def record(*args, **kwargs):
+    return telemetry.record(*args, **kwargs)
+
+def report():
+    return telemetry.report()
+
+def write_jsonl(path=EVENTS_PATH):
+    telemetry.write_jsonl(path)
+
+def write_prometheus(path=METRICS_PATH):
+    telemetry.write_prometheus(path)
@@ -0,0 +1,190 @@
+import re
+import Token_Counter
+
+# Places a chunk may end, strongest first. Positions are character offsets that line
+# up with the start of the next token (tiktoken keeps leading whitespace on a token).
+PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*')
+SENTENCE_BREAK = re.compile(r'[.!?]["\')\]]*(?=\s)')
+
+# A chunk is cut at a boundary only if it keeps at least this fraction of the token budget
+MIN_FILL = 0.5
+
+
+def is_continuation(byte):
+    return 0x80 <= byte < 0xC0
+
+def encode_with_offsets(text, model=Token_Counter.DEFAULT_MODEL):
+    """
+    Encode text once and find where each token starts in it.
+
+    A character can be split across tokens (many emoji and CJK characters are). A token
+    that starts partway through a character gets that character's offset, the same as
+    tiktoken's decode_with_offsets, and is not a place text can be cut: slicing there
+    would leave the character out of one side and pull earlier tokens into the other.
+
+    Returns:
+        tuple: (list of tokens, list of character offsets where each token starts, list
+            that is True for each token that starts at a character boundary)
+    """
+    encoding = Token_Counter.get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    offsets = []
+    cuttable = []
+    length = 0
+    for piece in encoding.decode_tokens_bytes(tokens):
+        continues = is_continuation(piece[0])
+        offsets.append(max(0, length - continues))
+        cuttable.append(not continues)
+        length += sum(1 for byte in piece if not is_continuation(byte))
+    return tokens, offsets, cuttable
+
+def boundary_positions(text):
+    """
+    Returns:
+        tuple: (set of paragraph break offsets, set of sentence break offsets)
+    """
+    paragraphs = set()
+    for match in PARAGRAPH_BREAK.finditer(text):
+        paragraphs.add(match.start())
+        paragraphs.add(match.end())
+    sentences = {match.end() for match in SENTENCE_BREAK.finditer(text)}
+    return paragraphs, sentences
+
+def find_cut(text, offsets, cuttable, start, end, paragraphs, sentences):
+    """
+    Pick the token index to end a chunk at: the last paragraph break, sentence break or
+    word break in the back half of [start, end], or else the last token at or before end
+    that starts a character. Only when a single character takes up every token after
+    start does the cut move past end, to the first token after that character.
+    """
+    lowest = start + max(1, int((end - start) * MIN_FILL))
+    for is_boundary in (
+        lambda position: position in paragraphs,
+        lambda position: position in sentences,
+        lambda position: text[position].isspace(),
+    ):
+        for i in range(end, lowest - 1, -1):
+            if cuttable[i] and is_boundary(offsets[i]):
+                return i
+    for i in range(end, start, -1):
+        if cuttable[i]:
+            return i
+    return next((i for i in range(end + 1, len(cuttable)) if cuttable[i]), len(cuttable))
+
+def chunk_text(text, max_tokens, overlap=0, model=Token_Counter.DEFAULT_MODEL):
+    """
+    Split text into chunks of at most max_tokens tokens, encoding it only once.
+
+    Cuts are made on token offsets and moved back to the nearest paragraph, sentence or
+    word boundary when one is close enough. Chunks are sliced from the original text, so
+    no characters are lost or mangled at the cuts.
+
+    Args:
+        text (str): Text to split
+        max_tokens (int): Maximum tokens per chunk
+        overlap (int): Tokens from the end of each chunk repeated at the start of the next
+        model (str): Model whose tokenizer to use
+
+    Returns:
+        list: List of text chunks
+    """
+    tokens, offsets, cuttable = encode_with_offsets(text, model)
+    total = len(tokens)
+    if total <= max_tokens:
+        return [text]
+
+    max_tokens = max(1, max_tokens)
+    overlap = max(0, min(overlap, max_tokens // 2))
+    paragraphs, sentences = boundary_positions(text)
+
+    chunks = []
+    start = 0
+    while True:
+        end = start + max_tokens
+        if end >= total:
+            chunks.append(text[offsets[start]:])
+            return chunks
+
+        end = find_cut(text, offsets, cuttable, start, end, paragraphs, sentences)
+        if end >= total:
+            chunks.append(text[offsets[start]:])
+            return chunks
+        chunks.append(text[offsets[start]:offsets[end]])
+        # The overlap shrinks rather than starting partway through a character
+        start = max(end - overlap, start + 1)
+        while not cuttable[start]:
+            start += 1
+
+def truncate_text(text, max_tokens, model=Token_Counter.DEFAULT_MODEL):
+    """
+    Cut text down to its first max_tokens tokens.
+
+    Args:
+        text (str): The text to truncate
+        max_tokens (int): Maximum number of tokens allowed
+        model (str): Model whose tokenizer to use
+
+    Returns:
+        str: The longest prefix of text that fits in max_tokens tokens
+    """
+    if max_tokens <= 0:
+        return ""
+
+    tokens, offsets, _ = encode_with_offsets(text, model)
+    if len(tokens) <= max_tokens:
+        return text
+    # A character split at the limit is left out along with the tokens before it
+    return text[:offsets[max_tokens]]
+
+def pack(token_counts, budget, separator_tokens=0, strategy='ffd'):
+    """
+    Group items into as few bins as possible without re-tokenizing anything.
+
+    Each item costs its own token count plus one separator, and each bin holds
+    budget + separator_tokens, since the first item in a bin needs no separator.
+
+    Args:
+        token_counts (list): Token count of each item
+        budget (int): Maximum tokens in a bin once its items are joined
+        separator_tokens (int): Tokens added by the separator between two items
+        strategy (str): 'ffd' for first-fit-decreasing, or 'ordered' to fill bins greedily
+            in input order
+
+    Returns:
+        list: Bins, each a list of item indices in input order. Bins are ordered by their
+            first item, and an item bigger than the budget gets a bin of its own.
+    """
+    capacity = budget + separator_tokens
+    costs = [count + separator_tokens for count in token_counts]
+
+    if strategy == 'ordered':
+        bins = []
+        free = 0
+        for i, cost in enumerate(costs):
+            if bins and cost <= free:
+                bins[-1].append(i)
+                free -= cost
+            else:
+                bins.append([i])
+                free = capacity - cost
+        return bins
+
+    if strategy != 'ffd':
+        raise ValueError(f"Unknown packing strategy: {strategy}")
+
+    bins = []
+    free = []
+    for i in sorted(range(len(costs)), key=costs.__getitem__, reverse=True):
+        for b, space in enumerate(free):
+            if costs[i] <= space:
+                bins[b].append(i)
+                free[b] -= costs[i]
+                break
+        else:
+            bins.append([i])
+            free.append(capacity - costs[i])
+
+    for items in bins:
+        items.sort()
+    bins.sort(key=lambda items: items[0])
+    return bins
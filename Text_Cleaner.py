@@ -0,0 +1,163 @@
+import html
+import re
+
+# Start of a forwarded message; its header block is kept as part of the body
+FORWARD_MARKER = re.compile(
+    r'^[ \t]*(-{2,}[ \t]*Forwarded message[ \t]*-{2,}|Begin forwarded message:)[ \t]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Lines that start the quoted reply chain or the signature; everything after them is dropped
+REPLY_CUTOFFS = [
+    re.compile(r'^-{2,}\s*Original Message\s*-{2,}$', re.IGNORECASE),
+    re.compile(r'^--$'),
+]
+REPLY_ATTRIBUTION = re.compile(r'^On\b.{0,200}\bwrote:$', re.IGNORECASE)
+OUTLOOK_HEADER = re.compile(r'^(From|Sent|Date|To|Cc|Subject):', re.IGNORECASE)
+FORWARD_SUBJECT = re.compile(r'^Subject:\s*(FW|Fwd?):', re.IGNORECASE)
+
+# Single lines that are dropped wherever they appear
+DROPPED_LINES = [
+    re.compile(r'^Sent from my \w+', re.IGNORECASE),
+    re.compile(r'^Get Outlook for \w+', re.IGNORECASE),
+    re.compile(r'^\[image:[^\]]*\]$', re.IGNORECASE),
+    # Outlook's separator above reply and forward headers
+    re.compile(r'^_{10,}$'),
+]
+
+# Paragraphs that are boilerplate rather than something the sender wrote, dropped when they
+# make up the footer at the end of a message
+BOILERPLATE = [
+    # Legal disclaimers
+    re.compile(r'intended (solely |only )?for the (use of the )?(individual|named|addressee|recipient)', re.IGNORECASE),
+    re.compile(r'if you (are not the intended recipient|have received this (e-?mail|message) in error)', re.IGNORECASE),
+    re.compile(r'confidential(ity)? (notice|information)', re.IGNORECASE),
+    # Unsubscribe and tracking footers
+    re.compile(r'\bunsubscribe\b', re.IGNORECASE),
+    re.compile(r'(manage|update) (your )?(e-?mail |subscription |notification )?preferences', re.IGNORECASE),
+    re.compile(r'view (this e-?mail |it )?in (your |a )?browser', re.IGNORECASE),
+    re.compile(r"you('re| are) receiving this (e-?mail|message)", re.IGNORECASE),
+    re.compile(r'you received this (e-?mail|message) because', re.IGNORECASE),
+    re.compile(r'no longer wish to receive', re.IGNORECASE),
+]
+# Longer paragraphs are assumed to be real content even if they mention one of the above
+MAX_BOILERPLATE_CHARS = 600
+
+# Signs that the rules could not make sense of the text
+HTML_TAG = re.compile(r'</?[a-zA-Z][a-zA-Z0-9]*(\s[^<>]*)?/?>')
+MAX_LEFTOVER_TAGS = 3
+MIN_KEPT_RATIO = 0.1
+MIN_LENGTH_FOR_RATIO = 500
+
+
+def clean_plain_text(text):
+    """
+    Clean a text/plain email body with deterministic rules: drop quoted replies,
+    signatures, disclaimers, and unsubscribe/tracking footers, but keep the header
+    block of any forwarded message.
+
+    Args:
+        text (str): Raw plain text body
+
+    Returns:
+        tuple: (cleaned text, True if the rules are confident in the result)
+    """
+    if not text or not text.strip():
+        return "", True
+
+    text = html.unescape(text.replace('\r\n', '\n').replace('\r', '\n'))
+    cleaned = collapse_blank_lines(clean_section(text))
+    return cleaned, is_confident(text, cleaned)
+
+def clean_section(text):
+    """
+    Clean text that may contain a forwarded message, recursing into the forwarded part.
+    """
+    match = FORWARD_MARKER.search(text)
+    if match is None:
+        return clean_body(text)
+
+    forwarded = text[match.start():].strip('\n')
+    header, _, rest = forwarded.partition('\n\n')
+    sections = [clean_body(text[:match.start()]), header.strip(), clean_section(rest)]
+    return '\n\n'.join(section for section in sections if section)
+
+def clean_body(text):
+    """
+    Clean text that contains no forwarded message.
+    """
+    lines = text.split('\n')
+    kept = []
+
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if is_reply_cutoff(stripped, lines, i):
+            break
+        if stripped.startswith('>'):
+            continue
+        if any(pattern.match(stripped) for pattern in DROPPED_LINES):
+            continue
+        kept.append(line.rstrip())
+
+    paragraphs = re.split(r'\n\s*\n', '\n'.join(kept))
+    return '\n\n'.join(paragraph.strip('\n') for paragraph in strip_footer(paragraphs)).strip()
+
+def strip_footer(paragraphs):
+    """
+    Drop the run of boilerplate paragraphs at the end of a message. Boilerplate-looking
+    paragraphs with real content after them are left alone, since they are more likely
+    something the sender wrote about (an unsubscribe link, say) than a footer.
+    """
+    end = len(paragraphs)
+    while end > 1 and (not paragraphs[end - 1].strip() or is_boilerplate(paragraphs[end - 1])):
+        end -= 1
+    return paragraphs[:end]
+
+def is_reply_cutoff(stripped, lines, i):
+    """
+    Check whether line i starts the quoted reply chain or the signature.
+    """
+    if any(pattern.match(stripped) for pattern in REPLY_CUTOFFS):
+        return True
+
+    # "On <date>, <name> wrote:" is often wrapped onto a second line
+    if stripped.startswith('On '):
+        if REPLY_ATTRIBUTION.match(stripped):
+            return True
+        if i + 1 < len(lines) and REPLY_ATTRIBUTION.match(stripped + ' ' + lines[i + 1].strip()):
+            return True
+
+    # Outlook-style reply header: a From: line followed by Sent:/Date:/To: lines,
+    # unless its subject marks it as a forward
+    if stripped.lower().startswith('from:'):
+        block = [line.strip() for line in lines[i + 1:i + 6] if line.strip()]
+        if len(block) >= 2 and all(OUTLOOK_HEADER.match(line) for line in block[:2]):
+            return not any(FORWARD_SUBJECT.match(line) for line in block)
+
+    return False
+
+def is_boilerplate(paragraph):
+    if len(paragraph) > MAX_BOILERPLATE_CHARS:
+        return False
+    return any(pattern.search(paragraph) for pattern in BOILERPLATE)
+
+def collapse_blank_lines(text):
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def is_confident(original, cleaned):
+    """
+    Flag results the rules probably got wrong: leftover HTML, or almost nothing kept from
+    a message that had real content.
+    """
+    if len(HTML_TAG.findall(cleaned)) >= MAX_LEFTOVER_TAGS:
+        return False
+
+    original_length = len(original.strip())
+    if not cleaned and original_length > 0:
+        # Nothing left is only expected when the message was entirely quoted text
+        return all(line.strip().startswith('>') or not line.strip() for line in original.split('\n'))
+
+    if original_length >= MIN_LENGTH_FOR_RATIO and len(cleaned) < original_length * MIN_KEPT_RATIO:
+        return False
+
+    return True
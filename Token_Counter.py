@@ -0,0 +1,228 @@
+import collections
+import functools
+import hashlib
+import os
+import re
+import threading
+import tiktoken
+
+DEFAULT_MODEL = "gpt-4"
+
+# Number of (encoding, text) counts remembered before the least recently used is dropped
+CACHE_SIZE = 20000
+
+# Threads tiktoken may use for encode_batch
+ENCODE_THREADS = 8
+
+# Total tokens (prompt plus completion) each model accepts, longest prefix match wins
+CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4.1-mini": 1047576,
+    "gpt-4.1-nano": 1047576,
+    "gpt-3.5-turbo": 16385,
+}
+
+# Most tokens each model will write in one completion, longest prefix match wins
+MAX_OUTPUT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 4096,
+    "gpt-4o": 16384,
+    "gpt-4o-mini": 16384,
+    "gpt-4.1": 32768,
+    "gpt-4.1-mini": 32768,
+    "gpt-4.1-nano": 32768,
+    "gpt-3.5-turbo": 4096,
+}
+
+# Pieces the local tokenizer splits text into before cutting them to LOCAL_TOKEN_BYTES:
+# words and numbers keep one leading space, as tiktoken's do
+LOCAL_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+")
+
+# Most UTF-8 bytes in one local token, about the average of a real English token
+LOCAL_TOKEN_BYTES = 4
+
+
+class LocalEncoding:
+    """
+    Deterministic stand-in for a tiktoken encoding that needs no download, so the local
+    backend can run offline. Counts approximate the real tokenizers' but are not exact.
+
+    Each token is its own bytes behind a 0x01 marker byte read as a big-endian integer,
+    so tokens decode back to bytes without a vocabulary. Like tiktoken's, a token can
+    end partway through a multi-byte character.
+    """
+
+    name = "local"
+
+    def encode(self, text, disallowed_special=()):
+        tokens = []
+        for piece in LOCAL_PIECES.findall(text):
+            data = piece.encode('utf-8')
+            for i in range(0, len(data), LOCAL_TOKEN_BYTES):
+                tokens.append(int.from_bytes(b'\x01' + data[i:i + LOCAL_TOKEN_BYTES], 'big'))
+        return tokens
+
+    def encode_batch(self, texts, num_threads=ENCODE_THREADS, disallowed_special=()):
+        return [self.encode(text, disallowed_special) for text in texts]
+
+    def decode_tokens_bytes(self, tokens):
+        return [token.to_bytes((token.bit_length() + 7) // 8, 'big')[1:] for token in tokens]
+
+    def decode(self, tokens):
+        return b''.join(self.decode_tokens_bytes(tokens)).decode('utf-8', errors='replace')
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=DEFAULT_MODEL):
+    """
+    tiktoken downloads an encoding the first time it is used and keeps it in
+    TIKTOKEN_CACHE_DIR. With LLM_BACKEND=local the local tokenizer is used unless
+    TIKTOKEN_CACHE_DIR is set (pre-seed it with the .tiktoken files for exact counts
+    offline), and it is also used whenever the encoding cannot be loaded.
+
+    Returns:
+        tiktoken.Encoding or LocalEncoding: The encoding for a model, loaded once and
+            reused afterwards
+    """
+    if os.getenv("LLM_BACKEND", "openai") == "local" and not os.getenv("TIKTOKEN_CACHE_DIR"):
+        return LocalEncoding()
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return LocalEncoding()
+
+def model_limit(limits, model):
+    """
+    Returns:
+        int: The entry for a model in a table of limits, falling back to the smallest entry
+    """
+    matches = [name for name in limits if model.startswith(name)]
+    if not matches:
+        return min(limits.values())
+    return limits[max(matches, key=len)]
+
+def context_window(model=DEFAULT_MODEL):
+    return model_limit(CONTEXT_WINDOWS, model)
+
+def max_output_tokens(model=DEFAULT_MODEL):
+    return model_limit(MAX_OUTPUT_TOKENS, model)
+
+
+class TokenCounter:
+    """
+    Token counter that memoizes counts by content hash in a bounded LRU.
+
+    Counts are keyed by encoding name rather than model, so models sharing an encoding
+    share cached counts. Special-token text such as "<|endoftext|>" is counted as
+    ordinary text instead of raising.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(encoding, text):
+        return encoding.name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _lookup(self, key):
+        with self.lock:
+            count = self.cache.get(key)
+            if count is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.cache.move_to_end(key)
+            return count
+
+    def _store(self, key, count):
+        with self.lock:
+            self.cache[key] = count
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def count(self, text, model=DEFAULT_MODEL):
+        """
+        Args:
+            text (str): Text to count
+            model (str): Model whose tokenizer to use
+
+        Returns:
+            int: Number of tokens in text
+        """
+        encoding = get_encoding(model)
+        key = self._key(encoding, text)
+        count = self._lookup(key)
+        if count is None:
+            count = len(encoding.encode(text, disallowed_special=()))
+            self._store(key, count)
+        return count
+
+    def count_many(self, texts, model=DEFAULT_MODEL):
+        """
+        Count tokens for many texts at once, encoding every cache miss in a single
+        multithreaded encode_batch call.
+
+        Args:
+            texts (list): Texts to count
+            model (str): Model whose tokenizer to use
+
+        Returns:
+            list: Token count for each text, in order
+        """
+        encoding = get_encoding(model)
+        keys = [self._key(encoding, text) for text in texts]
+        counts = [self._lookup(key) for key in keys]
+
+        # Identical texts only need encoding once
+        missing = {}
+        for i, count in enumerate(counts):
+            if count is None:
+                missing.setdefault(keys[i], texts[i])
+
+        if missing:
+            encoded = encoding.encode_batch(list(missing.values()), num_threads=ENCODE_THREADS,
+                                            disallowed_special=())
+            new_counts = dict(zip(missing, (len(tokens) for tokens in encoded)))
+            for key, count in new_counts.items():
+                self._store(key, count)
+            counts = [new_counts[key] if count is None else count for key, count in zip(keys, counts)]
+
+        return counts
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, hit_rate and the number of cached entries
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.cache),
+            }
+
+
+# Shared counter used throughout the program
+counter = TokenCounter()
+
+def count_tokens(text, model=DEFAULT_MODEL):
+    return counter.count(text, model)
+
+def count_many(texts, model=DEFAULT_MODEL):
+    return counter.count_many(texts, model)
+
+def stats():
+    return counter.stats()
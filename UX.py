@@ -1,15 +1,32 @@
 import Gmail_Interface
 import AI_API
 import VectorDB
+import Mailbox_Sync
+import Email_Extractor
+import Message_Store
+import Telemetry
+import Token_Counter
 import sys
 
+def print_stream(stream):
+    """
+    Print an AI_API.CompletionStream as it arrives, followed by how long it took.
+    """
+    for piece in stream:
+        print(piece, end="", flush=True)
+    print()
+    if stream.first_token_latency is not None:
+        print(f"(first token after {stream.first_token_latency:.2f}s, done after {stream.total_latency:.2f}s)")
+
 def main():
     print("Starting program...")
     service = Gmail_Interface.start_up()
     vector_db = VectorDB.initialize_VectorDB()
     # gmail_Objects = Gmail_Interface.get_unread_emails(service)
-    email_objects = Gmail_Interface.get_unread_email_objects(service)
-    VectorDB.add_emails_to_vectorDB(vector_db, email_objects)
+    store = Message_Store.MessageStore()
+    mailbox = Mailbox_Sync.MailboxSync(service, vector_db, store)
+    mailbox.full_sync()
+    email_objects = mailbox.email_objects()
     while True:
         print("What do you want to do? Type 'help' for a list of commands")
         user_input = input("> ")
@@ -23,7 +40,26 @@ def main():
             Gmail_Interface.send_email(service, user_input)
 
         elif user_input == "summarize emails":
-            print(AI_API.summarize_Emails(email_objects))
+            mailbox.load_bodies()
+            # Emails already extracted are summarized from their stored extractions
+            Email_Extractor.load_stored(email_objects, store)
+            print_stream(AI_API.stream_summarize_Emails(email_objects))
+
+        elif user_input == "list emails":
+            # Only needs headers, so no bodies are downloaded
+            for email in email_objects:
+                print(f"From: {email.sender} | Subject: {email.subject}")
+
+        elif user_input == "triage emails":
+            mailbox.load_bodies()
+            Email_Extractor.extract_emails(email_objects, store)
+            # Most urgent first, newest first within each level
+            ranked = sorted((email for email in email_objects if email.extraction),
+                            key=lambda email: (-Email_Extractor.URGENCY_LEVELS.index(email.extraction.urgency),
+                                               -email.internal_date))
+            for email in ranked:
+                print(f"[{email.extraction.urgency.upper()}] From: {email.sender} | Subject: {email.subject}")
+                print("    " + Email_Extractor.extraction_text(email.extraction).replace("\n", "\n    "))
 
         elif user_input == "I'd like to ask a question about a specific email":
             print("What is the email address that sent the email you're looking for? Type None if you don't know")
@@ -34,20 +70,46 @@ def main():
 
             print("And what is your question?")
             question = input("> ")
+            mailbox.ensure_indexed()
             vector_Response = VectorDB.query_vectorDB_combined(vector_db, question, sender)
             body = VectorDB.extract_body_text_from_results(vector_Response)
+            # Structured details already extracted for the matching emails go in as extra context
+            matches = [mailbox.emails[msg_id] for msg_id in VectorDB.extract_ids_from_results(vector_Response)
+                       if msg_id in mailbox.emails]
+            Email_Extractor.load_stored(matches, store)
+            body = "\n\n".join([Email_Extractor.extraction_text(email.extraction)
+                                  for email in matches if email.extraction] + list(body))
             from_address = VectorDB.extract_from_address_from_results(vector_Response)
-            output = AI_API.answer_question_with_context(question, from_address, body, 5000)
-            print(output)
+            print_stream(AI_API.stream_answer_question_with_context(question, from_address, body))
+
+        elif user_input == "stats":
+            # Every LLM and embedding call made this session, by pipeline stage
+            print(Telemetry.report())
+            token_stats = Token_Counter.stats()
+            print(f"Token counts: {token_stats['hits']} cached, {token_stats['misses']} computed")
+            cache = AI_API.get_completion_cache()
+            if cache is not None:
+                cache_stats = cache.stats()
+                print(f"Completion cache: {cache_stats['hit_rate']:.0%} hit rate, {cache_stats['entries']} entries, "
+                      f"{cache_stats['bytes'] / 1_000_000:.1f} MB")
+
+        elif user_input == "export stats":
+            Telemetry.write_jsonl()
+            Telemetry.write_prometheus()
+            print(f"Wrote {Telemetry.EVENTS_PATH} and {Telemetry.METRICS_PATH}")
 
         elif user_input == "help":
             print("""
             send an email
             summarize emails
+            list emails
+            triage emails
             I'd like to ask a question about a specific email
             exit
             restart
             send summary email
+            stats
+            export stats
             """)
 
         elif user_input == "exit":
@@ -55,12 +117,15 @@ def main():
 
         elif user_input == "restart":
             service = Gmail_Interface.start_up()
-            vector_db = VectorDB.initialize_VectorDB()
-            gmail_Objects = Gmail_Interface.get_unread_emails(service)
-            email_objects = Gmail_Interface.get_unread_email_objects(service)
-            VectorDB.add_emails_to_vectorDB(vector_db, email_objects)
+            mailbox.service = service
+            # Only download and embed what changed since the last sync
+            added, removed = mailbox.refresh()
+            email_objects = mailbox.email_objects()
+            print(f"Refreshed: {added} new, {removed} removed")
 
         elif user_input == "send summary email":
+            mailbox.load_bodies()
+            Email_Extractor.load_stored(email_objects, store)
             summary = AI_API.summarize_Emails(email_objects)
             Gmail_Interface.send_email(service, summary)
         
@@ -388,4 +453,7 @@ elif user_input == "get unread emails":
                 print(f"From: {sender}")
                 print("---")
 
-'''
\ No newline at end of file
+'''
+
+if __name__ == "__main__":
+    main()
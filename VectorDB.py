@@ -1,22 +1,49 @@
 import chromadb
+import time
 import uuid
 import Gmail_Interface
-from chromadb.utils import embedding_functions
-import os
+import LLM_Backend
+import Telemetry
+import Token_Counter
+from chromadb.api.types import EmbeddingFunction
 import dotenv
+from email.utils import parseaddr
 
 # load the environment variables
 dotenv.load_dotenv()
 
+# Number of emails embedded per collection.add call when ingesting a stream
+INGEST_BATCH_SIZE = 100
+
+
+class BackendEmbeddingFunction(EmbeddingFunction):
+    """
+    ChromaDB embedding function that embeds through an LLM_Backend backend, recording
+    each call in Telemetry.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __call__(self, input):
+        model = self.backend.embedding_model
+        start = time.perf_counter()
+        try:
+            embeddings = self.backend.embed(input)
+        except Exception as e:
+            Telemetry.record("embedding", "embed", model, "error", time.perf_counter() - start,
+                             error=type(e).__name__)
+            raise
+        Telemetry.record("embedding", "embed", model, "ok", time.perf_counter() - start,
+                         sum(Token_Counter.count_many(list(input), model)))
+        return embeddings
+
 
 def initialize_VectorDB():
     client = chromadb.Client()
     
-    # Create an embedding function (uses OpenAI by default)
-    embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=os.getenv("OPENAI_API_KEY"),  # or use environment variable
-        model_name="text-embedding-3-small"
-    )
+    # Create an embedding function (OpenAI's text-embedding-3-small unless LLM_BACKEND=local)
+    embedding_function = BackendEmbeddingFunction(LLM_Backend.get_backend())
     
     # Create collection with embedding function
     collection = client.create_collection(
@@ -25,13 +52,16 @@ def initialize_VectorDB():
     )
     return collection
 
-def add_emails_to_vectorDB(collection, email_objects):
+def add_email_batch_to_vectorDB(collection, email_objects):
     """
-    Add Email objects to the vector database with automatic embeddings.
+    Add one batch of Email objects to the vector database with automatic embeddings.
     
     Args:
         collection: ChromaDB collection
         email_objects: List of Email objects (from Gmail_Interface.Email class)
+        
+    Returns:
+        list: IDs assigned to the added emails
     """
     if not email_objects:
         return []
@@ -44,20 +74,21 @@ def add_emails_to_vectorDB(collection, email_objects):
     emails = [Gmail_Interface.prepend_with_title(
         "Subject", subject, email) for subject, email in zip(subjects, emails)]
     
-    # Generate unique IDs for each email
-    ids = [str(uuid.uuid4()) for _ in email_objects]
+    # Key each document by its Gmail message ID when known so it can be removed on sync
+    ids = [getattr(email, 'message_id', None) or str(uuid.uuid4()) for email in email_objects]
     
     # Create metadata for each email
     metadatas = []
     for i in range(len(email_objects)):
         metadata = {
             "from_address": from_addresses[i],
-
+            # Lowercased bare address, so a sender filter doesn't need the display name
+            "sender_address": getattr(email_objects[i], 'sender_address', '') or '',
         }
         metadatas.append(metadata)
     
     # Now ChromaDB will automatically generate embeddings
-    collection.add(
+    collection.upsert(
         documents=emails,
         ids=ids,
         metadatas=metadatas
@@ -65,12 +96,52 @@ def add_emails_to_vectorDB(collection, email_objects):
     
     return ids
 
+def add_emails_to_vectorDB(collection, email_objects, batch_size=INGEST_BATCH_SIZE):
+    """
+    Add Email objects to the vector database with automatic embeddings.
+    
+    Args:
+        collection: ChromaDB collection
+        email_objects: Iterable of Email objects (from Gmail_Interface.Email class); may be a
+            generator, in which case emails are embedded batch by batch as they arrive
+        batch_size (int): Number of emails embedded per collection.add call
+        
+    Returns:
+        list: IDs assigned to the added emails
+    """
+    ids = []
+    batch = []
+    
+    for email in email_objects:
+        batch.append(email)
+        if len(batch) == batch_size:
+            ids.extend(add_email_batch_to_vectorDB(collection, batch))
+            batch = []
+    
+    if batch:
+        ids.extend(add_email_batch_to_vectorDB(collection, batch))
+    
+    return ids
+
+def remove_emails_from_vectorDB(collection, ids):
+    """
+    Remove emails from the vector database.
+    
+    Args:
+        collection: ChromaDB collection
+        ids: List of document IDs (Gmail message IDs) to remove
+    """
+    if not ids:
+        return
+    
+    collection.delete(ids=list(ids))
+
 def query_vectorDB_combined(collection, query_text, sender=None, n_results=1):
     """Search email body text with optional sender filtering"""
     where_conditions = {}
     
     if sender:
-        where_conditions["from_address"] = sender
+        where_conditions["sender_address"] = parseaddr(sender)[1].lower() or sender.strip().lower()
     
     results = collection.query(
         query_texts=[query_text],  # Search the email body text
@@ -119,3 +190,18 @@ def extract_from_address_from_results(results):
     
     return ""
 
+
+def extract_ids_from_results(results):
+    """Extract document IDs (Gmail message IDs) from ChromaDB query results
+    
+    Args:
+        results: Dictionary returned from collection.query() containing ids, documents, metadatas, etc.
+        
+    Returns:
+        list: List of IDs of the matching documents
+    """
+    if not results or not results.get('ids'):
+        return []
+    
+    # ChromaDB returns ids as a list of lists (one list per query)
+    return results['ids'][0]